@@ -0,0 +1,272 @@
+"""Developer benchmark of the client-side hot paths against local stand-ins for S3 and Lambda.
+
+Each size runs the real code for every stage of a scan:
+- reading targets (count_targets and iter_targets);
+- dispatching them (invoke_async);
+- waiting for completion markers (wait_for_completion);
+- building the report (combine_json, build_bundle and upload_index).
+
+The stub Lambda plays the part of the screenshot and analyze functions and
+writes a synthetic result and completion marker for every target. Both stubs
+run in a child process, so the figures cover the client only.
+
+    python -m _tools.benchmark --sizes 1000,10000 --save-baseline baseline.json
+    python -m _tools.benchmark --sizes 1000,10000 --baseline baseline.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+BUCKET = 'flashbulb-benchmark'
+REGION = 'us-east-1'
+# One target in this many fails, so error markers and reports are exercised too
+ERROR_EVERY = 100
+# Slowdowns shorter than this are treated as noise however large the ratio
+NOISE_SECONDS = 0.25
+STAGES = ['targets', 'invoke', 'wait', 'combine', 'bundle', 'index']
+
+
+def _result_record(url, prefix, safe_url, number):
+    return {
+        'startUrl': url,
+        'finalUrl': url + '/',
+        'status': {'code': (200, 200, 200, 301, 403, 404, 500)[number % 7], 'text': 'OK'},
+        'category': ('No inputs', 'User input', 'Password input')[number % 3],
+        'title': 'Benchmark page {} for host {}'.format(number, number % 997),
+        'ipAddress': {'ip': '10.{}.{}.{}'.format(number >> 16 & 255, number >> 8 & 255, number & 255),
+                      'port': 80},
+        'screenshot': prefix + safe_url + '.jpg',
+        'thumbnail': prefix + safe_url + '.thumb.jpg',
+        'technologies': [{'name': name, 'icon': name + '.svg'}
+                         for name in ('Nginx', 'jQuery', 'WordPress', 'React', 'PHP')[:number % 5]],
+        'region': REGION,
+        'coldStart': {'screenshot': number % 50 == 1, 'analyze': number % 50 == 1},
+        'timings': {'context': 40 + number % 20, 'navigation': 800 + number * 7919 % 4000,
+                    'screenshot': 300 + number % 200, 'upload': 90, 'queue': 150, 'analyze': 60,
+                    'total': 1500 + number * 7919 % 4000},
+    }
+
+
+def _serve_stubs(connection):
+    """Run both stubs and answer counter requests from the benchmark process."""
+    from _tools.stub_lambda import StubLambdaServer
+    from _tools.stub_s3 import StubS3Server
+    from modules.completion import MARKER_DIR, get_safe_url
+
+    s3 = StubS3Server(('127.0.0.1', 0))
+    counter = {'targets': 0}
+
+    def on_invoke(function_name, invocation_type, payload):
+        prefix = payload.get('prefix', '')
+        for url in payload.get('urls') or [payload['url']]:
+            with s3.lock:
+                counter['targets'] += 1
+                number = counter['targets']
+            safe_url = get_safe_url(url)
+            status = 'error.other' if number % ERROR_EVERY == 0 else 'ok'
+            if status == 'ok':
+                record = _result_record(url, prefix, safe_url, number)
+                s3.put(BUCKET, prefix + safe_url + '.json', json.dumps(record).encode('utf-8'))
+            else:
+                record = {'url': url, 'class': 'other', 'message': 'benchmark failure', 'attempt': 1}
+                s3.put(BUCKET, prefix + 'errors/' + safe_url + '.json', json.dumps(record).encode('utf-8'))
+            timestamp = '{:013d}'.format(int(time.time() * 1000))
+            s3.put(BUCKET, '{}{}{}-{}-{}'.format(prefix, MARKER_DIR, timestamp, status, safe_url), b'')
+        return {}
+
+    aws_lambda = StubLambdaServer(('127.0.0.1', 0), on_invoke=on_invoke)
+    for server in (s3, aws_lambda):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    connection.send((s3.endpoint, aws_lambda.endpoint))
+
+    while True:
+        command = connection.recv()
+        if command == 'counts':
+            with s3.lock:
+                counts = dict(s3.requests)
+            counts['Invoke'] = aws_lambda.invocations
+            connection.send(counts)
+        elif command == 'clear':
+            s3.clear()
+            aws_lambda.invocations = 0
+            counter['targets'] = 0
+            connection.send(True)
+        else:
+            return
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class Stage:
+    """Time one stage and count the stub requests it made."""
+
+    def __init__(self, connection, results, name, num_objects):
+        self.connection = connection
+        self.results = results
+        self.name = name
+        self.num_objects = num_objects
+
+    def _counts(self):
+        self.connection.send('counts')
+        return self.connection.recv()
+
+    def __enter__(self):
+        self._before = self._counts()
+        self._peak_before = _peak_rss_mb()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self._start
+        peak = _peak_rss_mb()
+        after = self._counts()
+        requests = {name: after[name] - self._before.get(name, 0) for name in after
+                    if after[name] != self._before.get(name, 0)}
+        self.results[self.name] = {
+            'seconds': seconds,
+            'objects_per_second': self.num_objects / seconds if seconds > 0 else 0.0,
+            'requests': sum(requests.values()),
+            'request_counts': requests,
+            # The process high-water mark, which includes every earlier stage and size
+            'peak_rss_mb': peak,
+            # How far this stage raised it, 0 when it stayed under an earlier peak
+            'peak_growth_mb': peak - self._peak_before,
+        }
+        return False
+
+
+def run_size(connection, size, config):
+    """Run every stage for one number of targets and return the per-stage results."""
+    from modules.bundle import build_bundle
+    from modules.completion import CompletionTracker
+    from modules.report import COMBINED_NAME, combine_json, upload_index
+    from modules.run import count_targets, invoke_async, iter_targets, wait_for_completion
+
+    prefix = 'bench-{}/'.format(size)
+    results = {}
+    with tempfile.TemporaryFile('w+') as target_list:
+        for i in range(size):
+            target_list.write('host{}.benchmark.example\n'.format(i))
+
+        target_list.seek(0)
+        with Stage(connection, results, 'targets', size):
+            count_targets(target_list, False)
+            target_list.seek(0)
+            hosts = list(iter_targets(target_list, False))
+
+    options = SimpleNamespace(regions=[REGION], concurrency=config.concurrency, batch_size=config.batch_size,
+                              bucket=BUCKET, prefix=prefix, image_format='jpeg', image_quality=80,
+                              thumbnail_width=320)
+    tracker = CompletionTracker(BUCKET, prefix)
+    with Stage(connection, results, 'invoke', len(hosts)):
+        num_targets = asyncio.run(invoke_async(iter(hosts), options))
+    del hosts
+
+    with Stage(connection, results, 'wait', num_targets):
+        if not wait_for_completion(BUCKET, prefix, num_targets, silent=True, tracker=tracker):
+            raise RuntimeError('Not every benchmark target completed')
+
+    with Stage(connection, results, 'combine', num_targets):
+        entries, combined_etag = combine_json(BUCKET, prefix)
+    with Stage(connection, results, 'bundle', len(entries)):
+        build_bundle(BUCKET, prefix, prefix + COMBINED_NAME, entries, combined_etag)
+    with Stage(connection, results, 'index', 1):
+        upload_index(BUCKET, prefix)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print each stage against the baseline and return the list of regressions."""
+    regressions = []
+    for size, stages in results.items():
+        for name in STAGES:
+            before = baseline.get(size, {}).get(name)
+            if before is None or name not in stages:
+                continue
+            now = stages[name]
+            ratio = now['seconds'] / before['seconds'] if before['seconds'] > 0 else 1.0
+            slower = ratio > 1 + tolerance and now['seconds'] - before['seconds'] > NOISE_SECONDS
+            chattier = now['requests'] > before['requests']
+            flag = ' REGRESSION' if slower or chattier else ''
+            print('{:>9} {:<8} {:>8.2f}s vs {:>8.2f}s ({:+.0%}), {} vs {} requests{}'.format(
+                size, name, now['seconds'], before['seconds'], ratio - 1,
+                now['requests'], before['requests'], flag))
+            if flag:
+                regressions.append((size, name))
+    return regressions
+
+
+def print_results(size, stages):
+    print('{} targets'.format(size))
+    print('  {:<8} {:>10} {:>12} {:>10} {:>14} {:>11}'.format(
+        'stage', 'seconds', 'objects/s', 'requests', 'peak so far MB', 'raised MB'))
+    for name in STAGES:
+        stage = stages[name]
+        print('  {:<8} {:>10.3f} {:>12.0f} {:>10} {:>14.0f} {:>11.0f}'.format(
+            name, stage['seconds'], stage['objects_per_second'], stage['requests'], stage['peak_rss_mb'],
+            stage.get('peak_growth_mb', 0)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Flashbulb against local S3 and Lambda stand-ins')
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='Comma separated target counts, for example 1000,10000,100000,1000000')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--baseline', help='Compare against results saved by an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Slowdown over the baseline that counts as a regression (default 0.25)')
+    parser.add_argument('--save-baseline', help='Write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='Show Flashbulb log output')
+    config = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if config.verbose else logging.WARNING,
+                        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    parent, child = multiprocessing.Pipe()
+    stubs = multiprocessing.Process(target=_serve_stubs, args=(child,), daemon=True)
+    stubs.start()
+    s3_endpoint, lambda_endpoint = parent.recv()
+    os.environ.update({
+        'AWS_ENDPOINT_URL_S3': s3_endpoint,
+        'AWS_ENDPOINT_URL_LAMBDA': lambda_endpoint,
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'AWS_DEFAULT_REGION': REGION,
+    })
+
+    all_results = {}
+    try:
+        for size in [int(size) for size in config.sizes.split(',')]:
+            parent.send('clear')
+            parent.recv()
+            all_results[str(size)] = run_size(parent, size, config)
+            print_results(size, all_results[str(size)])
+    finally:
+        parent.send('stop')
+        stubs.join(timeout=5)
+
+    if config.save_baseline:
+        with open(config.save_baseline, 'w') as f:
+            json.dump(all_results, f, indent=2)
+        print('Saved baseline to {}'.format(config.save_baseline))
+    if config.baseline:
+        with open(config.baseline) as f:
+            regressions = compare(all_results, json.load(f), config.tolerance)
+        if regressions:
+            print('{} stages regressed'.format(len(regressions)))
+            exit(1)
@@ -1,39 +1,127 @@
-"""Developer function to upload copies of a zip file across every region."""
+"""Developer function to upload copies of a zip file across every region.
+
+Each copy is tagged with the SHA-256 of the file, so regions that already hold
+the same content are skipped and an interrupted upload can simply be rerun.
+Honours AWS_ENDPOINT_URL_S3, so it can be tried against _tools/stub_s3.py.
+"""
 
-import boto3
 import argparse
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from common.constants import FLASHBULB_BUCKET_PREFIX
+from common.utils import get_enabled_regions
+
+COPY_WORKERS = 8
+# Layers above this size are copied in parts, several at a time
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+                                 multipart_chunksize=MULTIPART_CHUNKSIZE, max_concurrency=4)
+HASH_CHUNK = 1024 * 1024
+
+
+def file_sha256(path):
+    """Return the hex SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _client(region):
+    return boto3.client('s3', region_name=region, config=Config(max_pool_connections=TRANSFER_CONFIG.max_request_concurrency))
+
+
+def stored_sha256(aws_s3, region, dest):
+    """Return the SHA-256 recorded on a region's copy, or None if there is no copy."""
+    try:
+        response = aws_s3.head_object(Bucket=FLASHBULB_BUCKET_PREFIX + region, Key=dest)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return response.get('Metadata', {}).get('sha256', '')
+
+
+def print_timings(regions, timings):
+    print('{:<16} {:<10} {:>8}'.format('region', 'action', 'seconds'))
+    for region in regions:
+        action, seconds = timings[region]
+        print('{:<16} {:<10} {:>8}'.format(region, action, '-' if seconds is None else '{:.1f}'.format(seconds)))
+
+
+def global_upload(file, dest, regions=None, workers=COPY_WORKERS):
+    """Make sure every region's Flashbulb bucket holds file at dest and return the per-region timings."""
+    regions = regions or get_enabled_regions()
+    digest = file_sha256(file)
+    clients = {region: _client(region) for region in regions}
+    timings = {}
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(regions))) as executor:
+        stored = dict(zip(regions, executor.map(lambda region: stored_sha256(clients[region], region, dest), regions)))
+        current = [region for region in regions if stored[region] == digest]
+        missing = [region for region in regions if stored[region] != digest]
+        # Regions that already hold this exact file are skipped
+        for region in current:
+            timings[region] = ('skipped', 0.0)
+        if not missing:
+            print('Every region already holds {} ({})'.format(dest, digest[:12]))
+            print_timings(regions, timings)
+            return timings
+
+        # One upload from this machine, then every other copy stays inside S3
+        if current:
+            source = current[0]
+        else:
+            source = missing.pop(0)
+            print('Uploading to {}...'.format(source), end='', flush=True)
+            start = time.time()
+            clients[source].upload_file(file, FLASHBULB_BUCKET_PREFIX + source, dest,
+                                        ExtraArgs={'Metadata': {'sha256': digest}}, Config=TRANSFER_CONFIG)
+            timings[source] = ('uploaded', time.time() - start)
+            print('Done')
+
+        def copy(region):
+            start = time.time()
+            clients[region].copy({'Bucket': FLASHBULB_BUCKET_PREFIX + source, 'Key': dest},
+                                 FLASHBULB_BUCKET_PREFIX + region, dest,
+                                 ExtraArgs={'Metadata': {'sha256': digest}, 'MetadataDirective': 'REPLACE'},
+                                 SourceClient=clients[source], Config=TRANSFER_CONFIG)
+            return time.time() - start
+
+        print('Copying from {} to {} regions...'.format(source, len(missing)), flush=True)
+        futures = {region: executor.submit(copy, region) for region in missing}
+        failed = []
+        for region, future in futures.items():
+            try:
+                timings[region] = ('copied', future.result())
+            except ClientError as e:
+                timings[region] = ('failed', None)
+                failed.append((region, e))
 
-def global_upload(file, dest):
-    aws_ec2 = boto3.client('ec2')
-    response = aws_ec2.describe_regions(
-        Filters=[
-            {
-                'Name': 'opt-in-status',
-                'Values': [
-                    'opted-in',
-                    'opt-in-not-required'
-                ]
-            }
-        ]
-    )
-    region_names = [r['RegionName'] for r in response['Regions']]
-
-    r1 = region_names[0]
-    s3 = boto3.resource('s3')
-    print('Uploading to {}...'.format(r1), end='', flush=True)
-    s3.Object('flashbulb-' + r1, dest).upload_file(file)
-    print('Done')
-
-    for region in region_names[1:]:
-        print('Copying to {}...'.format(region), end='', flush=True)
-        s3.Object('flashbulb-'+region, dest).copy_from(CopySource='flashbulb-'+r1+'/'+dest)
-        print('Done')
+    print_timings(regions, timings)
+    for region, error in failed:
+        print('Copy to {} failed - {}'.format(region, error))
+    if failed:
+        exit(-1)
+    return timings
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('file')
     parser.add_argument('dest')
+    parser.add_argument('--regions', type=lambda value: value.split(','),
+                        help="Comma-separated regions to upload to. Defaults to every enabled region")
+    parser.add_argument('--workers', type=int, default=COPY_WORKERS, help="Regions to copy to at once")
 
     config = parser.parse_args()
-    global_upload(config.file, config.dest)
+    global_upload(config.file, config.dest, config.regions, config.workers)
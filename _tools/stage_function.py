@@ -1,25 +1,50 @@
-from common.constants import FLASHBULB_DIR, FLASHBULB_BUCKET_PREFIX
-from common.utils import check_function, get_function_s3_key
-import pathlib
-from zipfile import ZipFile
-from _tools.global_upload import global_upload
+from common.constants import FLASHBULB_DIR
+from common.utils import get_function_s3_key
+import io
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+from _tools.global_upload import file_sha256, global_upload, stored_sha256
 import boto3
-from botocore.exceptions import ClientError
+
+# A fixed timestamp and mode make the zip depend only on the source, so its
+# hash only changes when the code does
+ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+ZIP_MODE = 0o644 << 16
+
+
+# Modules used by every function, packaged next to each function's index.js
+SHARED_DIR = FLASHBULB_DIR.joinpath('lambdas').joinpath('shared')
+
+
+def build_zip(files):
+    """Return the bytes of a reproducible zip holding a dict of archive names to paths."""
+    buffer = io.BytesIO()
+    with ZipFile(buffer, 'w', ZIP_DEFLATED) as archive:
+        for name in sorted(files):
+            info = ZipInfo(name, date_time=ZIP_DATE)
+            info.external_attr = ZIP_MODE
+            info.compress_type = ZIP_DEFLATED
+            archive.writestr(info, files[name].read_bytes())
+    return buffer.getvalue()
+
 
 def stage_function(key):
-    aws_s3 = boto3.client('s3')
-    try:
-        aws_s3.head_object(Bucket=FLASHBULB_BUCKET_PREFIX + 'us-east-1', Key=get_function_s3_key(key))
-        print("Did you forget to increment the {} function version?".format(key.title()))
-        exit(-1)
-    except ClientError:
-        pass
-    
-    
     screenshot_dir = FLASHBULB_DIR.joinpath('lambdas').joinpath(key)
     zip_path = screenshot_dir.joinpath('function.zip')
 
-    with ZipFile(zip_path, 'w') as myzip:
-        myzip.write(screenshot_dir.joinpath('index.js'), arcname='index.js')
+    files = {path.name: path for path in SHARED_DIR.glob('*.js')}
+    files['index.js'] = screenshot_dir.joinpath('index.js')
+    contents = build_zip(files)
+    if zip_path.exists() and zip_path.read_bytes() == contents:
+        print('{} is up to date'.format(zip_path.name))
+    else:
+        zip_path.write_bytes(contents)
+    digest = file_sha256(zip_path)
+
+    # A staged version may only be uploaded again with the same content, to finish an interrupted upload
+    aws_s3 = boto3.client('s3', region_name='us-east-1')
+    staged = stored_sha256(aws_s3, 'us-east-1', get_function_s3_key(key))
+    if staged is not None and staged != digest:
+        print("Did you forget to increment the {} function version?".format(key.title()))
+        exit(-1)
 
     global_upload(str(zip_path), get_function_s3_key(key))
@@ -0,0 +1,90 @@
+"""Developer stand-in for a recursive DNS resolver, for exercising run --resolve locally.
+
+Pass it to Flashbulb with --resolvers 127.0.0.1:<port>. Names it has records for
+get A or AAAA answers, everything else is NXDOMAIN.
+"""
+
+import argparse
+import ipaddress
+import socketserver
+import struct
+import threading
+import time
+
+from modules.resolve import TYPE_A, TYPE_AAAA, RCODE_NOERROR, RCODE_NXDOMAIN, encode_name
+
+
+class StubDnsServer(socketserver.ThreadingUDPServer):
+    """Threaded UDP server answering from a fixed table of names."""
+
+    daemon_threads = True
+
+    def __init__(self, address, records=None, latency=0.0, unanswered=None):
+        super().__init__(address, StubDnsHandler)
+        self.records = {name.lower(): list(addresses) for name, addresses in (records or {}).items()}
+        self.latency = latency
+        # Names whose queries are dropped, to exercise timeouts
+        self.unanswered = set(unanswered or [])
+        self.queries = 0
+        self._lock = threading.Lock()
+
+    @property
+    def address(self):
+        return '{}:{}'.format(*self.server_address)
+
+    def answer(self, name, qtype):
+        """Return the response code and the addresses to answer with."""
+        with self._lock:
+            self.queries += 1
+        if name not in self.records:
+            return RCODE_NXDOMAIN, []
+        version = 4 if qtype == TYPE_A else 6
+        return RCODE_NOERROR, [ipaddress.ip_address(address) for address in self.records[name]
+                               if ipaddress.ip_address(address).version == version]
+
+
+class StubDnsHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        data, sock = self.request
+        query_id = struct.unpack('!H', data[:2])[0]
+        labels = []
+        offset = 12
+        while data[offset]:
+            labels.append(data[offset + 1:offset + 1 + data[offset]].decode('ascii'))
+            offset += data[offset] + 1
+        qtype = struct.unpack('!H', data[offset + 1:offset + 3])[0]
+        question = data[12:offset + 5]
+        name = '.'.join(labels).lower()
+        if name in self.server.unanswered:
+            return
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        rcode, addresses = self.server.answer(name, qtype)
+        answers = b''
+        for address in addresses:
+            rtype = TYPE_A if address.version == 4 else TYPE_AAAA
+            answers += encode_name(name) + struct.pack('!HHIH', rtype, 1, 300, len(address.packed)) + address.packed
+        header = struct.pack('!HHHHHH', query_id, 0x8180 | rcode, 1, len(addresses), 0, 0)
+        sock.sendto(header + question + answers, self.client_address)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=5353)
+    parser.add_argument('--record', action='append', default=[], metavar='NAME=ADDRESS',
+                        help='Answer NAME with ADDRESS, may be repeated')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before answering each query')
+    config = parser.parse_args()
+
+    records = {}
+    for record in config.record:
+        name, address = record.split('=', 1)
+        records.setdefault(name, []).append(address)
+    server = StubDnsServer(('127.0.0.1', config.port), records, config.latency)
+    print('Stub DNS listening on {}'.format(server.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Answered {} queries'.format(server.queries))
@@ -0,0 +1,110 @@
+"""Developer stand-in for the Lambda Invoke API, for exercising dispatch locally.
+
+Point the client at it with AWS_ENDPOINT_URL_LAMBDA=http://127.0.0.1:<port>.
+"""
+
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+INVOKE_PATH = re.compile(r'^/2015-03-31/functions/([^/]+)/invocations')
+
+
+class StubLambdaServer(ThreadingHTTPServer):
+    """Threaded HTTP server that accepts and counts Lambda invocations."""
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, on_invoke=None, max_concurrency=None):
+        super().__init__(address, StubLambdaHandler)
+        self.latency = latency
+        self.on_invoke = on_invoke
+        self.max_concurrency = max_concurrency
+        self.invocations = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def endpoint(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def enter(self):
+        """Reserve a concurrency slot, returning False if the call should be throttled."""
+        with self._lock:
+            if self.max_concurrency is not None and self.in_flight >= self.max_concurrency:
+                self.throttled += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def record(self, function_name, invocation_type, payload):
+        with self._lock:
+            self.invocations += 1
+        if self.on_invoke is not None:
+            return self.on_invoke(function_name, invocation_type, payload)
+        return {}
+
+
+class StubLambdaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        match = INVOKE_PATH.match(self.path)
+        if match is None:
+            self._respond(404, {'Message': 'Unknown path'})
+            return
+
+        if not self.server.enter():
+            self._respond(429, {'Type': 'User', 'message': 'Rate Exceeded.'},
+                          error_type='TooManyRequestsException')
+            return
+        try:
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            invocation_type = self.headers.get('X-Amz-Invocation-Type', 'RequestResponse')
+            payload = json.loads(body) if body else None
+            result = self.server.record(match.group(1), invocation_type, payload)
+        finally:
+            self.server.leave()
+        if invocation_type == 'Event':
+            self._respond(202, None)
+        else:
+            self._respond(200, result)
+
+    def _respond(self, status, body, error_type=None):
+        data = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if error_type is not None:
+            self.send_header('X-Amzn-ErrorType', error_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=9001)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before answering each call')
+    parser.add_argument('--max-concurrency', type=int, default=None,
+                        help='Throttle calls beyond this many in flight, like a concurrency limit')
+    config = parser.parse_args()
+
+    server = StubLambdaServer(('127.0.0.1', config.port), config.latency, max_concurrency=config.max_concurrency)
+    print('Stub Lambda listening on {}'.format(server.endpoint))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Received {} invocations, throttled {}'.format(server.invocations, server.throttled))
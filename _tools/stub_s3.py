@@ -0,0 +1,267 @@
+"""Developer stand-in for the subset of the S3 API Flashbulb uses.
+
+Point the client at it with AWS_ENDPOINT_URL_S3=http://127.0.0.1:<port>. Buckets
+are created on first write and live in memory only.
+"""
+
+import argparse
+import hashlib
+import re
+import threading
+import uuid
+from collections import Counter
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+RANGE = re.compile(r'bytes=(\d+)-(\d*)')
+
+
+class StubS3Server(ThreadingHTTPServer):
+    """Threaded HTTP server holding objects in memory and counting requests."""
+
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, StubS3Handler)
+        self.buckets = {}
+        self.uploads = {}
+        self.requests = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def endpoint(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def put(self, bucket, key, body, metadata=None, content_type=None):
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        with self.lock:
+            self.buckets.setdefault(bucket, {})[key] = {
+                'body': bytes(body),
+                'etag': etag,
+                'metadata': metadata or {},
+                'content_type': content_type or 'binary/octet-stream',
+                'modified': formatdate(usegmt=True),
+            }
+        return etag
+
+    def get(self, bucket, key):
+        with self.lock:
+            return self.buckets.get(bucket, {}).get(key)
+
+    def clear(self):
+        """Drop every object and request count."""
+        with self.lock:
+            self.buckets.clear()
+            self.uploads.clear()
+            self.requests.clear()
+
+
+class StubS3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _target(self):
+        parts = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(parts.query, keep_blank_values=True).items()}
+        path = unquote(parts.path).lstrip('/')
+        bucket, _, key = path.partition('/')
+        return bucket, key, query
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _respond(self, status, body=b'', headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _error(self, status, code):
+        self._respond(status, '<Error><Code>{}</Code><Message>{}</Message></Error>'.format(code, code),
+                      {'Content-Type': 'application/xml'})
+
+    def _count(self, operation):
+        with self.server.lock:
+            self.server.requests[operation] += 1
+
+    def do_GET(self):
+        bucket, key, query = self._target()
+        if not key:
+            self._count('ListObjectsV2')
+            self._list(bucket, query)
+            return
+        self._count('GetObject')
+        obj = self.server.get(bucket, key)
+        if obj is None:
+            self._error(404, 'NoSuchKey')
+            return
+        body = obj['body']
+        headers = self._object_headers(obj)
+        match = RANGE.match(self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(body) - 1
+            end = min(end, len(body) - 1)
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(body))
+            self._respond(206, body[start:end + 1], headers)
+        else:
+            self._respond(200, body, headers)
+
+    def do_HEAD(self):
+        bucket, key, query = self._target()
+        self._count('HeadObject')
+        obj = self.server.get(bucket, key)
+        if obj is None:
+            self._respond(404)
+            return
+        headers = self._object_headers(obj)
+        headers['Content-Length'] = str(len(obj['body']))
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def _object_headers(self, obj):
+        headers = {'ETag': obj['etag'], 'Content-Type': obj['content_type'], 'Last-Modified': obj['modified']}
+        for name, value in obj['metadata'].items():
+            headers['x-amz-meta-' + name] = value
+        return headers
+
+    def do_PUT(self):
+        bucket, key, query = self._target()
+        body = self._body()
+        source = self.headers.get('x-amz-copy-source')
+        if source is not None:
+            source_bucket, _, source_key = unquote(source).lstrip('/').partition('/')
+            source_obj = self.server.get(source_bucket, source_key)
+            if source_obj is None:
+                self._error(404, 'NoSuchKey')
+                return
+            body = source_obj['body']
+            match = RANGE.match(self.headers.get('x-amz-copy-source-range', ''))
+            if match:
+                body = body[int(match.group(1)):int(match.group(2)) + 1]
+
+        if 'uploadId' in query:
+            self._count('UploadPartCopy' if source is not None else 'UploadPart')
+            upload = self.server.uploads.get(query['uploadId'])
+            if upload is None:
+                self._error(404, 'NoSuchUpload')
+                return
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            upload['parts'][int(query['partNumber'])] = body
+            if source is not None:
+                self._respond(200, '<CopyPartResult><ETag>{}</ETag></CopyPartResult>'.format(escape(etag)),
+                              {'Content-Type': 'application/xml'})
+            else:
+                self._respond(200, headers={'ETag': etag})
+            return
+
+        metadata = {name[len('x-amz-meta-'):]: value for name, value in self.headers.items()
+                    if name.lower().startswith('x-amz-meta-')}
+        if source is not None:
+            self._count('CopyObject')
+            if self.headers.get('x-amz-metadata-directive', 'COPY') == 'COPY':
+                metadata = source_obj['metadata']
+            etag = self.server.put(bucket, key, body, metadata, source_obj['content_type'])
+            self._respond(200, '<CopyObjectResult><ETag>{}</ETag></CopyObjectResult>'.format(escape(etag)),
+                          {'Content-Type': 'application/xml'})
+            return
+        self._count('PutObject')
+        etag = self.server.put(bucket, key, body, metadata, self.headers.get('Content-Type'))
+        self._respond(200, headers={'ETag': etag})
+
+    def do_POST(self):
+        bucket, key, query = self._target()
+        body = self._body()
+        if 'uploads' in query:
+            self._count('CreateMultipartUpload')
+            upload_id = uuid.uuid4().hex
+            metadata = {name[len('x-amz-meta-'):]: value for name, value in self.headers.items()
+                        if name.lower().startswith('x-amz-meta-')}
+            self.server.uploads[upload_id] = {'bucket': bucket, 'key': key, 'parts': {}, 'metadata': metadata,
+                                              'content_type': self.headers.get('Content-Type')}
+            self._respond(200, '<InitiateMultipartUploadResult><Bucket>{}</Bucket><Key>{}</Key>'
+                               '<UploadId>{}</UploadId></InitiateMultipartUploadResult>'.format(
+                                   escape(bucket), escape(key), upload_id),
+                          {'Content-Type': 'application/xml'})
+        elif 'uploadId' in query:
+            self._count('CompleteMultipartUpload')
+            upload = self.server.uploads.pop(query['uploadId'], None)
+            if upload is None:
+                self._error(404, 'NoSuchUpload')
+                return
+            numbers = [int(e.text) for e in ElementTree.fromstring(body).iter()
+                       if e.tag.endswith('PartNumber')]
+            data = b''.join(upload['parts'][n] for n in numbers)
+            etag = self.server.put(bucket, key, data, upload['metadata'], upload['content_type'])
+            self._respond(200, '<CompleteMultipartUploadResult><Key>{}</Key><ETag>{}</ETag>'
+                               '</CompleteMultipartUploadResult>'.format(escape(key), escape(etag)),
+                          {'Content-Type': 'application/xml'})
+        elif 'delete' in query:
+            self._count('DeleteObjects')
+            keys = [e.text for e in ElementTree.fromstring(body).iter() if e.tag.endswith('Key')]
+            with self.server.lock:
+                objects = self.server.buckets.get(bucket, {})
+                for name in keys:
+                    objects.pop(name, None)
+            deleted = ''.join('<Deleted><Key>{}</Key></Deleted>'.format(escape(name)) for name in keys)
+            self._respond(200, '<DeleteResult>{}</DeleteResult>'.format(deleted),
+                          {'Content-Type': 'application/xml'})
+        else:
+            self._error(400, 'InvalidRequest')
+
+    def do_DELETE(self):
+        bucket, key, query = self._target()
+        if 'uploadId' in query:
+            self._count('AbortMultipartUpload')
+            self.server.uploads.pop(query['uploadId'], None)
+        else:
+            self._count('DeleteObject')
+            with self.server.lock:
+                self.server.buckets.get(bucket, {}).pop(key, None)
+        self._respond(204)
+
+    def _list(self, bucket, query):
+        prefix = query.get('prefix', '')
+        start_after = query.get('continuation-token') or query.get('start-after', '')
+        max_keys = int(query.get('max-keys', 1000))
+        with self.server.lock:
+            keys = sorted(k for k in self.server.buckets.get(bucket, {})
+                          if k.startswith(prefix) and k > start_after)
+            page = keys[:max_keys]
+            objects = [(k, self.server.buckets[bucket][k]) for k in page]
+        truncated = len(keys) > max_keys
+        contents = ''.join(
+            '<Contents><Key>{}</Key><ETag>{}</ETag><Size>{}</Size><LastModified>2020-01-01T00:00:00.000Z'
+            '</LastModified></Contents>'.format(escape(k), escape(o['etag']), len(o['body']))
+            for k, o in objects)
+        token = '<NextContinuationToken>{}</NextContinuationToken>'.format(escape(page[-1])) if truncated else ''
+        body = ('<ListBucketResult><Name>{}</Name><Prefix>{}</Prefix><KeyCount>{}</KeyCount>'
+                '<MaxKeys>{}</MaxKeys><IsTruncated>{}</IsTruncated>{}{}</ListBucketResult>').format(
+            escape(bucket), escape(prefix), len(page), max_keys, 'true' if truncated else 'false',
+            contents, token)
+        self._respond(200, body, {'Content-Type': 'application/xml'})
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=9000)
+    config = parser.parse_args()
+
+    server = StubS3Server(('127.0.0.1', config.port))
+    print('Stub S3 listening on {}'.format(server.endpoint))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(dict(server.requests))
@@ -36,14 +36,14 @@ FLASHBULB_BUCKET_PREFIX = 'flashbulb-'
 
 ENTITIES = {
     "screenshot": {
-        "version": SemanticVersion('0.7.1'),
+        "version": SemanticVersion('0.17.0'),
         "layers": [
             "chromium"
         ],
         "type": "function"
     },
     "analyze": {
-        "version": SemanticVersion('0.2.4'),
+        "version": SemanticVersion('0.9.0'),
         "layers": [
             "wappalyzer"
         ],
@@ -60,3 +60,5 @@ ENTITIES = {
 }
 
 FLASHBULB_DIR = pathlib.Path(__file__).parent.parent.absolute()
+
+CACHE_DIR = pathlib.Path(os.environ.get('XDG_CACHE_HOME', pathlib.Path.home().joinpath('.cache'))).joinpath('flashbulb')
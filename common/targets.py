@@ -0,0 +1,109 @@
+import bisect
+import sqlite3
+from urllib.parse import urlsplit, urlunsplit
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+# Memory SQLite may use for the seen URL table before it spills to disk, in KiB
+URL_CACHE_KB = 16384
+
+
+def host_range(network):
+    """Return the first and last integer address that network.hosts() would yield."""
+    first = int(network.network_address)
+    last = int(network.broadcast_address)
+    if network.version == 4 and network.prefixlen < 31:
+        return first + 1, last - 1
+    if network.version == 6 and network.prefixlen < 127:
+        return first + 1, last
+    return first, last
+
+
+def normalize_url(url):
+    """Return a canonical form of a URL so equivalent targets dedupe together."""
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    try:
+        if parts.port is not None and parts.port == DEFAULT_PORTS.get(scheme):
+            netloc = netloc.rsplit(':', 1)[0]
+    except ValueError:
+        # Invalid port, leave it for the browser to complain about
+        pass
+    return urlunsplit((scheme, netloc, parts.path, parts.query, parts.fragment))
+
+
+class IntervalSet:
+    """Set of integers stored as sorted, non-overlapping [start, end] ranges.
+
+    A whole CIDR range costs a single entry, no matter how many addresses it holds.
+    """
+
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+
+    def __contains__(self, value):
+        i = bisect.bisect_right(self._starts, value) - 1
+        return i >= 0 and self._ends[i] >= value
+
+    def add_range(self, start, end):
+        """Add [start, end] and return the sub-ranges that were not already present."""
+        i = bisect.bisect_right(self._starts, start) - 1
+        if i < 0 or self._ends[i] < start - 1:
+            i += 1
+
+        gaps = []
+        cursor = start
+        j = i
+        while j < len(self._starts) and self._starts[j] <= end + 1:
+            if self._starts[j] > cursor:
+                gaps.append((cursor, min(end, self._starts[j] - 1)))
+            cursor = max(cursor, self._ends[j] + 1)
+            j += 1
+        if cursor <= end:
+            gaps.append((cursor, end))
+
+        new_start = min(start, self._starts[i]) if i < j else start
+        new_end = max(end, self._ends[j - 1]) if i < j else end
+        self._starts[i:j] = [new_start]
+        self._ends[i:j] = [new_end]
+        return gaps
+
+
+class TargetFilter:
+    """Drop targets that have already been seen.
+
+    IP targets are tracked exactly as packed integer ranges per scheme. URLs are
+    compared exactly against a temporary SQLite table, which keeps at most
+    URL_CACHE_KB in memory and spills the rest to disk, so memory stays flat
+    however many distinct URLs a list has. Call close() to delete the table.
+    """
+
+    def __init__(self):
+        self._ranges = {}
+        # An empty name opens a private on-disk database that SQLite deletes on close
+        self._urls = sqlite3.connect('')
+        self._urls.execute('PRAGMA cache_size = -{:d}'.format(URL_CACHE_KB))
+        self._urls.execute('PRAGMA journal_mode = OFF')
+        self._urls.execute('PRAGMA synchronous = OFF')
+        self._urls.execute('CREATE TABLE urls (url TEXT PRIMARY KEY) WITHOUT ROWID')
+        self.duplicate_urls = 0
+
+    def new_addresses(self, scheme, network):
+        """Yield addresses from network.hosts() that have not been seen for scheme."""
+        ranges = self._ranges.setdefault((scheme, network.version), IntervalSet())
+        first, last = host_range(network)
+        address_class = type(network.network_address)
+        for start, end in ranges.add_range(first, last):
+            for value in range(start, end + 1):
+                yield address_class(value)
+
+    def add_url(self, url):
+        """Return True if the URL has not been seen before."""
+        if self._urls.execute('INSERT OR IGNORE INTO urls VALUES (?)', (url,)).rowcount == 0:
+            self.duplicate_urls += 1
+            return False
+        return True
+
+    def close(self):
+        self._urls.close()
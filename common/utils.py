@@ -1,10 +1,14 @@
 import re
 import boto3
 from botocore.exceptions import ClientError, NoCredentialsError
+import hashlib
+import json
 import logging
 import argparse
+import os
+import time
 
-from .constants import ENTITIES, SemanticVersion
+from .constants import CACHE_DIR, ENTITIES, SemanticVersion
 
 # Logging setup
 logger = logging.getLogger('flashbulb.utils')
@@ -14,6 +18,8 @@ ch = logging.StreamHandler()
 ch.setLevel(logging.INFO)
 logger.addHandler(ch)
 
+REGION_CACHE_TTL = 24 * 60 * 60
+
 
 def get_user_response(message, options, default=None):
     """Return an option the user selected from a list of available options."""
@@ -29,90 +35,122 @@ def get_user_response(message, options, default=None):
             userinput = input(prompt)
 
 
-def _list_lambda_functions(region):
-    aws_lambda = boto3.client('lambda', region_name=region)
-    marker = None
-    while True:
-        # Boto3 is dumb and will not allow default values
-        if marker is None:
-            response = aws_lambda.list_functions()
-        else:
-            response = aws_lambda.list_functions(Marker=marker)
-
-        yield from response['Functions']
-        if 'NextMarker' in response:
-            marker = response['NextMarker']
-        else:
-            break
+def normalize_prefix(prefix):
+    """Return a bucket prefix without leading slashes and ending in one, or '' for the bucket root."""
+    prefix = prefix.lstrip('/')
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    return prefix
 
 
-def get_function_by_key(key, region):
-    """Return a lambda function with the given name or None if it does not exist."""
-    expected_name = get_function_name(key)
-    for function in _list_lambda_functions(region):
-        if function['FunctionName'] == expected_name:
-            return function
-    return None
-
-
-def _list_lambda_layers(region):
-    aws_lambda = boto3.client('lambda', region_name=region)
-    marker = None
-    while True:
-        # Boto3 is dumb and will not allow default values
-        if marker is None:
-            response = aws_lambda.list_layers()
-        else:
-            response = aws_lambda.list_layers(Marker=marker)
-
-        yield from response['Layers']
-        if 'NextMarker' in response:
-            marker = response['NextMarker']
-        else:
-            break
+def get_function_by_key(key, region, aws_lambda=None):
+    """Return the configuration of a lambda function with the given key or None if it does not exist."""
+    aws_lambda = aws_lambda or boto3.client('lambda', region_name=region)
+    try:
+        return aws_lambda.get_function(FunctionName=get_function_name(key))['Configuration']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceNotFoundException':
+            return None
+        raise
 
 
-def get_layer_by_key(key, region):
-    """Return the ARN of a lambda layer with the given name or None if it does not exist."""
+def get_layer_by_key(key, region, aws_lambda=None):
+    """Return a lambda layer with its latest version or None if it does not exist."""
+    aws_lambda = aws_lambda or boto3.client('lambda', region_name=region)
     expected_name = get_layer_name(key)
-    for layer in _list_lambda_layers(region):
-        if layer['LayerName'] == expected_name:
-            return layer
-    return None
-
-
-def check_function(key, region):
-    function = get_function_by_key(key, region)
-    if function is None:
-        logger.error(
-            "Cannot find {function} function in {region}. Try running ./deploy for region {region}".format(region=region, function=key.title()))
-        exit(-1)
-    version = SemanticVersion(function['Description'])
+    try:
+        # Versions are listed newest first
+        response = aws_lambda.list_layer_versions(LayerName=expected_name, MaxItems=1)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceNotFoundException':
+            return None
+        raise
+    if not response['LayerVersions']:
+        return None
+    return {'LayerName': expected_name, 'LatestMatchingVersion': response['LayerVersions'][0]}
+
+
+def _check_version(kind, key, region, version):
     if version == ENTITIES[key]['version']:
-        return True
+        return None
     if version < ENTITIES[key]['version']:
-        return False
+        return "{0} {1} in region {2} is out of date. Try running ./update with region {2}".format(
+            key.title(), kind, region)
+    return "{} {} in {} has unknown version number. Update Flashbulb code and try again.".format(
+        key.title(), kind, region)
 
-    logger.error(
-        "{function} function in {region} has unknown version number. Update Flashbulb code and try again.".format(region=region, function=key.title()))
-    exit(-1)
+
+def check_function(key, region, aws_lambda=None):
+    """Return None if the deployed function is current, otherwise a description of the problem."""
+    function = get_function_by_key(key, region, aws_lambda)
+    if function is None:
+        return "Cannot find {function} function in {region}. Try running ./deploy for region {region}".format(
+            region=region, function=key.title())
+    return _check_version('function', key, region, SemanticVersion(function['Description']))
 
 
-def check_layer(key, region):
-    layer = get_layer_by_key(key, region)
+def check_layer(key, region, aws_lambda=None):
+    """Return None if the deployed layer is current, otherwise a description of the problem."""
+    layer = get_layer_by_key(key, region, aws_lambda)
     if layer is None:
-        logger.error(
-            "Cannot find {layer} layer in {region}. Try running ./deploy for region {region}".format(region=region, layer=key.title()))
-        exit(-1)
-    version = SemanticVersion(layer['LatestMatchingVersion']['Description'])
-    if version == ENTITIES[key]['version']:
-        return True
-    if version < ENTITIES[key]['version']:
-        return False
-    
-    logger.error(
-        "{layer} layer in {region} has unknown version number. Update Flashbulb code and try again.".format(region=region, layer=key.title()))
-    exit(-1)
+        return "Cannot find {layer} layer in {region}. Try running ./deploy for region {region}".format(
+            region=region, layer=key.title())
+    return _check_version('layer', key, region, SemanticVersion(layer['LatestMatchingVersion']['Description']))
+
+
+def load_cache(name, ttl):
+    """Return the contents of a local JSON cache file, or None if it is missing or older than ttl seconds."""
+    path = CACHE_DIR.joinpath(name)
+    try:
+        if time.time() - path.stat().st_mtime > ttl:
+            return None
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_cache(name, data):
+    """Write data to a local JSON cache file, ignoring failures since the cache is optional."""
+    path = CACHE_DIR.joinpath(name)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix('.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logger.debug('Could not write cache {} - {}'.format(path, e))
+
+
+def get_enabled_regions():
+    """Return the regions enabled for the account, cached on disk for a day."""
+    cache_name = 'regions-{}.json'.format(get_credentials_id())
+    regions = load_cache(cache_name, REGION_CACHE_TTL)
+    if regions is None:
+        aws_ec2 = boto3.client('ec2')
+        response = aws_ec2.describe_regions(
+            Filters=[
+                {
+                    'Name': 'opt-in-status',
+                    'Values': [
+                        'opted-in',
+                        'opt-in-not-required'
+                    ]
+                }
+            ]
+        )
+        regions = sorted(r['RegionName'] for r in response['Regions'])
+        save_cache(cache_name, regions)
+    return regions
+
+
+def get_credentials_id():
+    """Return an opaque identifier for the active AWS credentials, used to scope local caches."""
+    session = boto3.session.Session()
+    credentials = session.get_credentials()
+    access_key = credentials.access_key if credentials is not None else ''
+    return hashlib.sha256('{}:{}'.format(session.profile_name, access_key).encode('utf-8')).hexdigest()[:16]
 
 
 def get_layer_s3_key(key):
@@ -1,10 +1,6 @@
 import argparse
-import boto3
-from botocore.exceptions import ClientError, NoCredentialsError
-from modules.deploy import deploy_regions
-from modules.run import invoke_flashbulb
-from modules.update import update_regions
-from modules.destroy import destroy
+import importlib
+import pathlib
 import re
 import logging
 
@@ -15,27 +11,30 @@ ch = logging.StreamHandler()
 ch.setLevel(logging.INFO)
 logger.addHandler(ch)
 
+REGION_PATTERN = re.compile(r'^[a-z]{2}(-[a-z]+)+-\d+$')
+
+
 def parse_regions(region_string):
-    """Return a list of valid regions from a comma-separated input string."""
-    aws_ec2 = boto3.client('ec2')
-    response = aws_ec2.describe_regions(
-        Filters=[
-            {
-                'Name': 'opt-in-status',
-                'Values': [
-                    'opted-in',
-                    'opt-in-not-required'
-                ]
-            }
-        ]
-    )
-    valid_regions = {r['RegionName'] for r in response['Regions']}
-    input_regions = {r.lower() for r in re.split(r',\s*', region_string)}
-    invalid_regions = input_regions - valid_regions
-    if invalid_regions:
+    """Return a sorted list of region names from a comma-separated input string.
+
+    Only the syntax is checked here. Whether the regions are enabled needs AWS
+    credentials, so check_enabled_regions does that once they are verified.
+    """
+    input_regions = {r.lower() for r in re.split(r',\s*', region_string.strip())}
+    malformed = sorted(r for r in input_regions if not REGION_PATTERN.match(r))
+    if malformed:
+        raise argparse.ArgumentTypeError('Not a region name: {}'.format(', '.join(malformed)))
+    return sorted(input_regions)
+
+
+def parse_duration(duration_string):
+    """Return a number of seconds from a duration such as 3600, 90m, 24h or 7d."""
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([smhd]?)', duration_string.strip().lower())
+    if not match:
         raise argparse.ArgumentTypeError(
-            'The following regions are disabled for your account or do not exist: {}'.format(', '.join(invalid_regions)))
-    return sorted(list(input_regions))
+            'Durations look like 3600, 90m, 24h or 7d')
+    multiplier = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+    return float(match.group(1)) * multiplier
 
 
 def parse_lambda_execution_role(user_input):
@@ -46,9 +45,12 @@ def parse_lambda_execution_role(user_input):
 
 
 def check_credentials():
+    import boto3
+    from botocore.exceptions import BotoCoreError, ClientError, NoCredentialsError
+
     try:
-        aws_lambda = boto3.client('lambda')
-        aws_lambda.list_functions()
+        aws_sts = boto3.client('sts')
+        aws_sts.get_caller_identity()
     except ClientError as e:
         logger.debug('Login error - HTTP {} - {}'.format(
             e.response['ResponseMetadata']['HTTPStatusCode'], e.response['Error']['Message']))
@@ -57,6 +59,34 @@ def check_credentials():
     except NoCredentialsError:
         logger.error("No valid AWS credentials found, exiting")
         exit(-1)
+    except BotoCoreError as e:
+        logger.debug('Login error - {}'.format(e))
+        logger.error("No valid AWS credentials found, exiting")
+        exit(-1)
+
+
+def check_enabled_regions(regions):
+    """Exit if any of the regions is disabled for the account or does not exist."""
+    from botocore.exceptions import BotoCoreError, ClientError
+    from common.utils import get_enabled_regions
+
+    try:
+        valid_regions = set(get_enabled_regions())
+    except (BotoCoreError, ClientError) as e:
+        logger.debug('Could not list regions - {}'.format(e))
+        logger.error("Could not list the regions enabled for your account, exiting")
+        exit(-1)
+    invalid_regions = sorted(set(regions) - valid_regions)
+    if invalid_regions:
+        logger.error('The following regions are disabled for your account or do not exist: {}'.format(
+            ', '.join(invalid_regions)))
+        exit(-1)
+
+
+def load_command(path):
+    """Import and return a subcommand handler given as 'module:function'."""
+    module_name, function_name = path.split(':')
+    return getattr(importlib.import_module(module_name), function_name)
 
 
 if __name__ == '__main__':
@@ -71,27 +101,120 @@ if __name__ == '__main__':
     run_parser.add_argument(
         '--prefix', default='', help="Prefix to add to filenames in the bucket. By default, files are placed in bucket root.")
     run_parser.add_argument('--skip-tests', action='store_true', help="Skip the initial test to ensure functions are working properly in each region")
+    run_parser.add_argument('--test-deadline', type=float, default=45,
+                            help="Seconds each region's initial test may take before the region is reported as failing")
     run_parser.add_argument('--http-and-https', action='store_true',
                             help="Try to visit every site over http and https")
-    run_parser.set_defaults(func=invoke_flashbulb)
+    run_parser.add_argument('--concurrency', type=int, default=100,
+                            help="Maximum number of Lambda invocations in flight at once")
+    run_parser.add_argument('--batch-size', type=int, default=1,
+                            help="Number of targets each screenshot invocation visits with a single browser")
+    run_parser.add_argument('--image-format', choices=['jpeg', 'png'], default='jpeg',
+                            help="Encoding for full-size screenshots")
+    run_parser.add_argument('--image-quality', type=int, default=80,
+                            help="JPEG quality for full-size screenshots, from 0 to 100")
+    run_parser.add_argument('--thumbnail-width', type=int, default=320,
+                            help="Width in pixels of the JPEG thumbnail shown in the report, 0 to disable")
+    run_parser.add_argument('--resume', action='store_true',
+                            help="Continue an interrupted run, only dispatching targets without results in the bucket")
+    run_parser.add_argument('--max-age', type=parse_duration,
+                            help="Reuse results of earlier runs captured within this long (e.g. 24h) instead of screenshotting again")
+    run_parser.add_argument('--resolve', action='store_true',
+                            help="Resolve hostnames before dispatch and record those that do not exist as errors without invoking Lambda")
+    run_parser.add_argument('--resolvers', type=lambda value: re.split(r',\s*', value),
+                            help="Comma-separated DNS resolvers for --resolve, as address or address:port. Defaults to the system resolvers")
+    run_parser.add_argument('--collapse-endpoints', action='store_true',
+                            help="Resolve hostnames and screenshot only one target per scheme, address set, port and path")
+    run_parser.add_argument('--probe', action='store_true',
+                            help="Check that something accepts a TCP connection on each IP target's port before dispatch, recording the rest as errors")
+    run_parser.add_argument('--probe-rate', type=int, default=2000,
+                            help="Maximum new connections per second for --probe")
+    run_parser.add_argument('--probe-timeout', type=float, default=3.0,
+                            help="Seconds to wait for each --probe connection")
+    run_parser.add_argument('--retries', type=int, default=2,
+                            help="Times to dispatch a target again after a timeout, throttle, upload or browser failure, 0 to disable")
+    run_parser.add_argument('--prewarm', type=int, default=0, metavar='N',
+                            help="Start N screenshot containers per region before dispatch, so the first targets skip cold starts")
+    run_parser.add_argument('--cluster', action='store_true',
+                            help="Group near-identical screenshots in the report, needs NumPy and Pillow")
+    run_parser.add_argument('--journal', type=pathlib.Path,
+                            help="SQLite file recording each target's progress. Defaults to one per bucket and prefix under ~/.cache/flashbulb")
+    run_parser.set_defaults(func='modules.run:invoke_flashbulb')
     
+    warm_parser = subparsers.add_parser('warm', help='Start screenshot containers ahead of a run so it begins without cold starts')
+    warm_parser.add_argument('regions', type=parse_regions, default="us-east-2", help="A comma-separated list of AWS regions")
+    warm_parser.add_argument('--containers', type=int, default=10, help="Number of containers to start per region")
+    warm_parser.add_argument('--hold-ms', type=int, default=3000,
+                             help="Milliseconds each ping keeps its container busy so concurrent pings get separate containers")
+    warm_parser.set_defaults(func='modules.warm:warm')
+
+    selftest_parser = subparsers.add_parser('selftest', help='Check that the functions can screenshot, analyze and upload in every region')
+    selftest_parser.add_argument('regions', type=parse_regions, help="A comma-separated list of AWS regions")
+    selftest_parser.add_argument('bucket', help="S3 bucket the test result is written to and removed from")
+    selftest_parser.add_argument('--deadline', type=float, default=45,
+                                 help="Seconds each region's test may take before the region is reported as failing")
+    selftest_parser.set_defaults(func='modules.selftest:selftest')
+
+    cluster_parser = subparsers.add_parser('cluster', help='Rebuild a report with near-identical screenshots grouped, needs NumPy and Pillow')
+    cluster_parser.add_argument('bucket', help="S3 bucket holding the results")
+    cluster_parser.add_argument('prefix', nargs='?', default='', help="Prefix the results were written under")
+    cluster_parser.add_argument('--max-distance', type=int, default=4,
+                                help="Most of the 64 hash bits two screenshots may differ in to count as the same page")
+    cluster_parser.set_defaults(func='modules.cluster:cluster_report')
+
+    stats_parser = subparsers.add_parser('stats', help='Show where time went for each target of a run')
+    stats_parser.add_argument('bucket', help="S3 bucket holding the results")
+    stats_parser.add_argument('prefix', nargs='?', default='', help="Prefix the results were written under")
+    stats_parser.add_argument('--top', type=int, default=10, help="Number of slowest targets to list")
+    stats_parser.set_defaults(func='modules.stats:show_stats')
+
+    sync_parser = subparsers.add_parser('sync', help='Download the results of a run into a local database for querying')
+    sync_parser.add_argument('bucket', help="S3 bucket holding the results")
+    sync_parser.add_argument('prefix', nargs='?', default='', help="Prefix the results were written under")
+    sync_parser.add_argument('--workers', type=int, default=32, help="Results to download at once")
+    sync_parser.add_argument('--db', type=pathlib.Path,
+                             help="SQLite file to sync into. Defaults to one per bucket and prefix under ~/.cache/flashbulb")
+    sync_parser.set_defaults(func='modules.sync:sync_results')
+
+    query_parser = subparsers.add_parser('query', help='Search results downloaded with sync')
+    query_parser.add_argument('bucket', help="S3 bucket holding the results")
+    query_parser.add_argument('prefix', nargs='?', default='', help="Prefix the results were written under")
+    query_parser.add_argument('--tech', action='append', help="Only targets running this technology, may be repeated")
+    query_parser.add_argument('--status', type=lambda value: re.split(r',\s*', value),
+                              help="Comma-separated status codes or ranges such as 200,3xx")
+    query_parser.add_argument('--category', action='append', help="Input category such as 'Password input', may be repeated")
+    query_parser.add_argument('--ip', action='append', help="IP address or CIDR range, may be repeated")
+    query_parser.add_argument('--title', action='append', help="Text the page title contains, may be repeated")
+    query_parser.add_argument('--output', choices=['table', 'urls', 'json'], default='table')
+    query_parser.add_argument('--limit', type=int, default=100, help="Maximum results to print, 0 for all")
+    query_parser.add_argument('--count', action='store_true', help="Only print the number of matches")
+    query_parser.add_argument('--db', type=pathlib.Path, help="SQLite file written by sync")
+    # Reads only the local database, so it works offline
+    query_parser.set_defaults(func='modules.query:query_results', needs_aws=False)
+
     deploy_parser = subparsers.add_parser('deploy', help='Deploy Flashbulb to your AWS instance in specified regions')
     deploy_parser.add_argument('role_arn', type=parse_lambda_execution_role, help='Lambda execution role ARN to assign to Flashbulb lambda functions')
     deploy_parser.add_argument('regions', type=parse_regions, default="us-east-2", help="A comma-separated list of AWS regions")
-    deploy_parser.set_defaults(func=deploy_regions)
+    deploy_parser.set_defaults(func='modules.deploy:deploy_regions')
 
     update_parser = subparsers.add_parser('update', help='Update Flashbulb functions deployed to your AWS instance')
     update_parser.add_argument('regions', type=parse_regions, default="us-east-2", help="A comma-separated list of AWS regions")
-    update_parser.set_defaults(func=update_regions)
+    update_parser.set_defaults(func='modules.update:update_regions')
 
     destroy_parser = subparsers.add_parser('destroy', help='Destroy Flashbulb functions deployed to your AWS instance')
     destroy_parser.add_argument('regions', type=parse_regions, default="us-east-2", help="A comma-separated list of AWS regions")
-    destroy_parser.set_defaults(func=destroy)
+    destroy_parser.set_defaults(func='modules.destroy:destroy')
     
-    check_credentials()
     config = parser.parse_args()
     if config.debug:
         ch.setLevel(logging.DEBUG)
         logger.debug('Debug logs visible')
+    if not hasattr(config, 'func'):
+        parser.print_help()
+        exit(0)
 
-    config.func(config)
+    if getattr(config, 'needs_aws', True):
+        check_credentials()
+        if getattr(config, 'regions', None):
+            check_enabled_regions(config.regions)
+    load_command(config.func)(config)
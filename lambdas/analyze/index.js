@@ -2,21 +2,36 @@ const AWS = require("aws-sdk");
 const s3 = new AWS.S3();
 
 const fs = require("fs");
+const zlib = require("zlib");
 const Wappalyzer = require("wappalyzer-core");
 
-const errorHandler = (error, prefix, safeUrl, event) => {
-  let errorPath = prefix + "errors/" + safeUrl + ".txt";
-  const errorParams = {
-    Bucket: event.bucket,
-    Key: errorPath,
-    Body: error.stack,
-  };
-  s3.upload(errorParams, function (err, data) {
-    if (err) {
-      // Where is your god now?
-    }
-  });
+const { createErrorHandler, getSafeUrl, writeMarker } = require("./errors");
+
+const errorHandler = createErrorHandler("analyze");
+
+// Large pages are handed over as a reference to a gzipped artifact in S3
+const loadPage = async (event) => {
+  if (!event.page) {
+    return event;
+  }
+  const response = await s3
+    .getObject({ Bucket: event.bucket, Key: event.page })
+    .promise();
+  return { ...event, ...JSON.parse(zlib.gunzipSync(response.Body)) };
 };
+
+const deletePage = (event) => {
+  if (!event.page) {
+    return Promise.resolve();
+  }
+  return s3
+    .deleteObject({ Bucket: event.bucket, Key: event.page })
+    .promise()
+    .catch((err) => {
+      // A leftover artifact only costs storage
+    });
+};
+
 // Wappalyzer wants objects in string => [string] format...
 const processDict = (normalDict) => {
   let newDict = {};
@@ -34,34 +49,217 @@ const processCookies = (cookieList) => {
   return cookieDict;
 };
 
+// Both patterns need an input tag, so most pages skip the regex scan entirely
 const hasUserInput = (content) => {
-  return content.search(/<input[^>]*?type=("|')(?!hidden)[^>]*?>/) !== -1;
-}
+  return (
+    content.includes("<input") &&
+    content.search(/<input[^>]*?type=("|')(?!hidden)[^>]*?>/) !== -1
+  );
+};
 
 const hasPasswordInput = (content) => {
-  return content.search(/<input[^>]*?type=("|')password("|')[^>]*?>/) !== -1;
-}
+  return (
+    content.includes("<input") &&
+    content.includes("password") &&
+    content.search(/<input[^>]*?type=("|')password("|')[^>]*?>/) !== -1
+  );
+};
+
+const MIN_LITERAL_LENGTH = 3;
+const KEYED_TYPES = ["headers", "cookies", "meta"];
+const TEXT_TYPES = ["url", "html", "scripts"];
+
+// Returns the longest run of plain characters that every match of a pattern must
+// contain, or null when the pattern has none worth checking for
+const requiredLiteral = (pattern) => {
+  const source = String(pattern).split("\\;")[0];
+  let best = "";
+  let current = "";
+  const breakRun = () => {
+    if (current.length > best.length) {
+      best = current;
+    }
+    current = "";
+  };
+  for (let i = 0; i < source.length; i++) {
+    const char = source[i];
+    if (char === "\\") {
+      const next = source[++i];
+      if (next === undefined || /[0-9a-zA-Z]/.test(next)) {
+        if (!/[dwsbDWSBntrfv]/.test(next || "")) {
+          return null;
+        }
+        breakRun();
+      } else {
+        current += next;
+      }
+    } else if (char === "[") {
+      // Skip the whole character class
+      for (i++; i < source.length && source[i] !== "]"; i++) {
+        if (source[i] === "\\") {
+          i++;
+        }
+      }
+      breakRun();
+    } else if (char === "(") {
+      // Groups may be optional, so nothing inside them is relied on
+      let depth = 1;
+      for (i++; i < source.length && depth > 0; i++) {
+        if (source[i] === "\\") {
+          i++;
+        } else if (source[i] === "(") {
+          depth++;
+        } else if (source[i] === ")") {
+          depth--;
+        }
+      }
+      i--;
+      breakRun();
+    } else if (char === "|") {
+      // Top level alternation means no single literal is required
+      return null;
+    } else if (char === "?" || char === "*") {
+      current = current.slice(0, -1);
+      breakRun();
+    } else if (char === "{" && /^\{\d+(,\d*)?\}/.test(source.slice(i))) {
+      if (/^\{0[,}]/.test(source.slice(i))) {
+        current = current.slice(0, -1);
+      }
+      breakRun();
+      i = source.indexOf("}", i);
+    } else if (char === "+" || char === "." || char === "^" || char === "$") {
+      breakRun();
+    } else {
+      current += char;
+    }
+  }
+  breakRun();
+  best = best.toLowerCase();
+  return best.length >= MIN_LITERAL_LENGTH ? best : null;
+};
+
+const toList = (value) => (Array.isArray(value) ? value : [value]);
+
+// Module scope survives between invocations of a warm container
+let database = null;
+let coldStart = true;
+
+// Parses apps.json once and indexes each technology by the cheap signals its
+// patterns depend on, so detection only runs the patterns that could match
+const loadDatabase = () => {
+  if (database !== null) {
+    return database;
+  }
+  const { apps, categories } = JSON.parse(
+    fs.readFileSync("/opt/nodejs/node_modules/wappalyzer-core/apps.json")
+  );
+  Wappalyzer.setTechnologies(apps);
+  Wappalyzer.setCategories(categories);
+
+  const compiled = new Map(
+    Wappalyzer.technologies.map((technology) => [technology.name, technology])
+  );
+  const index = {
+    always: [],
+    keys: { headers: new Map(), cookies: new Map(), meta: new Map() },
+    literals: { url: [], html: [], scripts: [] },
+  };
+  const addTo = (map, key, technology) => {
+    if (!map.has(key)) {
+      map.set(key, []);
+    }
+    map.get(key).push(technology);
+  };
+
+  for (const [name, app] of Object.entries(apps)) {
+    const technology = compiled.get(name);
+    if (!technology) {
+      continue;
+    }
+    let unfiltered = false;
+    for (const type of KEYED_TYPES) {
+      for (const key of Object.keys(app[type] || {})) {
+        addTo(index.keys[type], key.toLowerCase(), technology);
+      }
+    }
+    for (const type of TEXT_TYPES) {
+      if (!app[type]) {
+        continue;
+      }
+      for (const pattern of toList(app[type])) {
+        const literal = requiredLiteral(pattern);
+        if (literal === null) {
+          unfiltered = true;
+        } else {
+          index.literals[type].push([literal, technology]);
+        }
+      }
+    }
+    if (unfiltered) {
+      index.always.push(technology);
+    }
+  }
+
+  database = { technologies: Wappalyzer.technologies, index: index };
+  return database;
+};
+
+// Returns the technologies that could possibly match, a small subset of the database
+const candidateTechnologies = (index, signals) => {
+  const candidates = new Set(index.always);
+  for (const type of KEYED_TYPES) {
+    for (const key of Object.keys(signals[type])) {
+      (index.keys[type].get(key.toLowerCase()) || []).forEach((technology) =>
+        candidates.add(technology)
+      );
+    }
+  }
+  const corpus = {
+    url: (signals.url || "").toLowerCase(),
+    html: (signals.html || "").toLowerCase(),
+    scripts: (signals.scripts || []).join("\n").toLowerCase(),
+  };
+  for (const type of TEXT_TYPES) {
+    for (const [literal, technology] of index.literals[type]) {
+      if (!candidates.has(technology) && corpus[type].includes(literal)) {
+        candidates.add(technology);
+      }
+    }
+  }
+  return [...candidates];
+};
 
 exports.handler = async (event, context, callback) => {
-  const safeUrl = event.startUrl.replace("://", "-").replace(/\//g, "__");
+  const safeUrl = getSafeUrl(event.startUrl);
   const prefix = event.prefix || "";
+  const startedAt = Date.now();
+  const isColdStart = coldStart;
+  coldStart = false;
 
   try {
-    const { apps: technologies, categories } = JSON.parse(
-      fs.readFileSync("/opt/nodejs/node_modules/wappalyzer-core/apps.json")
-    );
+    event = await loadPage(event);
+    const loadedAt = Date.now();
+    const { technologies, index } = loadDatabase();
+    const databaseAt = Date.now();
 
-    Wappalyzer.setTechnologies(technologies);
-    Wappalyzer.setCategories(categories);
-
-    const detections = Wappalyzer.analyze({
+    const signals = {
       url: event.finalUrl,
       meta: processDict(event.meta),
       headers: processDict(event.headers),
       scripts: event.scripts,
       cookies: processCookies(event.cookies),
       html: event.content,
-    });
+    };
+
+    // analyze() walks Wappalyzer.technologies, while resolve() needs the full
+    // list to follow implied technologies
+    let detections;
+    Wappalyzer.technologies = candidateTechnologies(index, signals);
+    try {
+      detections = Wappalyzer.analyze(signals);
+    } finally {
+      Wappalyzer.technologies = technologies;
+    }
 
     const results = Wappalyzer.resolve(detections);
 
@@ -73,6 +271,17 @@ exports.handler = async (event, context, callback) => {
       category = "Password input";
     }
 
+    // Stages run by the screenshot function are carried over from its payload
+    const finishedAt = Date.now();
+    const timings = {
+      ...event.timings,
+      queue: event.invokedAt ? startedAt - event.invokedAt : undefined,
+      load: loadedAt - startedAt,
+      database: databaseAt - loadedAt,
+      analyze: finishedAt - databaseAt,
+      total: event.startedAt ? finishedAt - event.startedAt : undefined,
+    };
+
     const pageInfo = {
       startUrl: event.startUrl,
       finalUrl: event.finalUrl,
@@ -80,8 +289,13 @@ exports.handler = async (event, context, callback) => {
       category: category,
       title: event.title,
       ipAddress: event.ipAddress,
-      screenshot: prefix + safeUrl + '.png',
+      screenshot: event.screenshot || prefix + safeUrl + ".png",
+      thumbnail: event.thumbnail || null,
       technologies: results,
+      region: event.region || process.env.AWS_REGION,
+      coldStart: { screenshot: Boolean(event.coldStart), analyze: isColdStart },
+      attempt: event.attempt || 1,
+      timings: timings,
     };
 
     let remotePageInfoPath = prefix + safeUrl + ".json";
@@ -90,14 +304,12 @@ exports.handler = async (event, context, callback) => {
       Key: remotePageInfoPath,
       Body: JSON.stringify(pageInfo),
     };
-    await s3.upload(pageInfoParams, function (err, data) {
-      if (err) {
-        errorHandler(err, prefix, safeUrl, event);
-      }
-    });
+    await s3.upload(pageInfoParams).promise();
+    await writeMarker(prefix, safeUrl, "ok", event);
+    await deletePage(event);
     return callback(null, pageInfo);
   } catch (error) {
-    errorHandler(err, prefix, safeUrl, event);
+    await errorHandler(error, event.startUrl, event);
     return callback(error);
   }
 };
@@ -1,43 +1,171 @@
-const fs = require("fs");
-
 const chromium = require("chrome-aws-lambda");
 
 const AWS = require("aws-sdk");
+const crypto = require("crypto");
+const zlib = require("zlib");
 const s3 = new AWS.S3();
 const lambda = new AWS.Lambda();
+const { createErrorHandler, getSafeUrl } = require("./errors");
 
-const errorHandler = (error, prefix, safeUrl, event) => {
-  let errorPath = prefix + "errors/" + safeUrl + ".txt";
-  const errorParams = {
-    Bucket: event.bucket,
-    Key: errorPath,
-    Body: error.stack,
+const errorHandler = createErrorHandler("screenshot");
+
+// Leave enough time to finish one more navigation before Lambda kills the batch
+const MIN_REMAINING_MS = 40000;
+// Page artifacts bigger than this go through S3, well under the 256 KB async invoke limit
+const MAX_INLINE_PAYLOAD = 192 * 1024;
+const DEFAULT_SELFTEST_DEADLINE_MS = 45000;
+
+// Module scope survives between invocations of a warm container
+let coldStart = true;
+const containerId = crypto.randomBytes(8).toString("hex");
+// The browser is kept between invocations, so only a cold container pays for a launch
+let sharedBrowser = null;
+
+const getBrowser = async (invocation) => {
+  if (sharedBrowser !== null && sharedBrowser.isConnected()) {
+    return sharedBrowser;
+  }
+  const launchStart = Date.now();
+  sharedBrowser = await chromium.puppeteer.launch({
+    args: chromium.args,
+    defaultViewport: chromium.defaultViewport,
+    executablePath: await chromium.executablePath,
+    headless: chromium.headless,
+    ignoreHTTPSErrors: true,
+  });
+  // The browser launch is charged to the first target of the batch only
+  invocation.timings.launch = Date.now() - launchStart;
+  return sharedBrowser;
+};
+
+const closeBrowser = async () => {
+  const browser = sharedBrowser;
+  sharedBrowser = null;
+  if (browser !== null) {
+    await browser.close().catch(() => {});
+  }
+};
+
+// Warm-up pings start the browser, then hold on to the container for a moment
+// so that concurrent pings each land in a container of their own
+const warmUp = async (event, context, invocation) => {
+  const startedAt = Date.now();
+  await getBrowser(invocation);
+  const initMs = Date.now() - startedAt;
+  const holdMs = Math.min(event.warmup.holdMs || 0, context.getRemainingTimeInMillis() - 1000);
+  if (holdMs > 0) {
+    await new Promise((resolve) => setTimeout(resolve, holdMs));
+  }
+  return {
+    containerId: containerId,
+    coldStart: invocation.coldStart,
+    initMs: initMs,
+    region: process.env.AWS_REGION,
   };
-  s3.upload(errorParams, function (err, data) {
-    if (err) {
-      // Where is your god now?
-    }
+};
+
+// Self-tests run one target through both functions and answer with the analyzed
+// result, so the client does not have to wait for it to appear in S3
+const selfTest = async (event, context, invocation) => {
+  const startedAt = Date.now();
+  const deadlineMs = Math.min(
+    event.selftest.deadlineMs || DEFAULT_SELFTEST_DEADLINE_MS,
+    context.getRemainingTimeInMillis() - 1000
+  );
+  const url = event.url || "https://example.com";
+  let timer;
+  const deadline = new Promise((resolve) => {
+    timer = setTimeout(
+      () => resolve({ url: url, error: "Self-test did not finish within " + deadlineMs + " ms" }),
+      deadlineMs
+    );
   });
+  const run = async () => {
+    const browser = await getBrowser(invocation);
+    const launchMs = Date.now() - startedAt;
+    return { ...(await screenshotTarget(browser, url, event, invocation)), launchMs: launchMs };
+  };
+  let result;
+  try {
+    result = await Promise.race([run(), deadline]);
+  } finally {
+    clearTimeout(timer);
+    // The target may still be running, and stops before its next write
+    invocation.cancelled = true;
+  }
+  return {
+    ...result,
+    containerId: containerId,
+    coldStart: invocation.coldStart,
+    region: process.env.AWS_REGION,
+    totalMs: Date.now() - startedAt,
+  };
 };
 
-exports.handler = async (event, context, callback) => {
-  let result = null;
-  let browser = null;
+// Records how long each stage took, in milliseconds since the previous stage
+const stageTimer = (timings) => {
+  let last = Date.now();
+  return (stage) => {
+    const now = Date.now();
+    timings[stage] = now - last;
+    last = now;
+  };
+};
+
+// DNS, connect and first byte times of the final document, as seen by the browser
+const navigationTimings = (page) =>
+  page
+    .evaluate(() => {
+      const [entry] = performance.getEntriesByType("navigation");
+      if (!entry) {
+        return {};
+      }
+      return {
+        dns: Math.round(entry.domainLookupEnd - entry.domainLookupStart),
+        connect: Math.round(entry.connectEnd - entry.connectStart),
+        ttfb: Math.round(entry.responseStart - entry.requestStart),
+      };
+    })
+    .catch(() => ({}));
+
+// Large pages are stored once, compressed, and analyze is handed a reference
+const offloadPage = async (pageInfo, artifact, prefix, safeUrl, event) => {
+  const inline = { ...pageInfo, ...artifact };
+  if (Buffer.byteLength(JSON.stringify(inline), "utf8") <= MAX_INLINE_PAYLOAD) {
+    return inline;
+  }
+  const pageKey = prefix + "_pages/" + safeUrl + ".json.gz";
+  const pageParams = {
+    Bucket: event.bucket,
+    Key: pageKey,
+    Body: zlib.gzipSync(JSON.stringify(artifact)),
+    ContentType: "application/json",
+    ContentEncoding: "gzip",
+  };
+  await s3.putObject(pageParams).promise();
+  return { ...pageInfo, page: pageKey };
+};
 
-  const safeUrl = event.url.replace("://", "-").replace(/\//g, "__");
+// A self-test that missed its deadline has been cleaned up by the client,
+// so it must not write anything more
+const checkCancelled = (invocation) => {
+  if (invocation.cancelled) {
+    throw new Error("Self-test was cancelled at its deadline");
+  }
+};
+
+const screenshotTarget = async (browser, url, event, invocation) => {
+  const safeUrl = getSafeUrl(url);
   const prefix = event.prefix || "";
-  // const scriptsDir = '/tmp/scripts'
-  // fs.mkdirSync(scriptsDir)
-  try {
-    browser = await chromium.puppeteer.launch({
-      args: chromium.args,
-      defaultViewport: chromium.defaultViewport,
-      executablePath: await chromium.executablePath,
-      headless: chromium.headless,
-      ignoreHTTPSErrors: true,
-    });
+  const startedAt = Date.now();
+  const timings = { ...invocation.timings };
+  const lap = stageTimer(timings);
+  // A fresh incognito context per target keeps cookies and cache isolated
+  const browserContext = await browser.createIncognitoBrowserContext();
 
-    let page = await browser.newPage();
+  try {
+    let page = await browserContext.newPage();
+    lap("context");
 
     let scripts = [];
 
@@ -47,24 +175,53 @@ exports.handler = async (event, context, callback) => {
       }
     });
 
-    const localScreenshotPath = "/tmp/screenshot.png";
-    const httpResponse = await page.goto(event.url || "https://example.com");
-    await page.screenshot({ path: localScreenshotPath });
+    const httpResponse = await page.goto(url);
+    Object.assign(timings, await navigationTimings(page));
+    lap("navigation");
 
-    const remoteScreenshotPath = prefix + safeUrl + ".png";
+    // The bundled puppeteer can only encode png and jpeg
+    const image = event.image || {};
+    const format = image.format === "jpeg" ? "jpeg" : "png";
+    const screenshotOptions = { type: format };
+    if (format === "jpeg") {
+      screenshotOptions.quality = image.quality || 80;
+    }
+    const screenshot = await page.screenshot(screenshotOptions);
 
-    const fileContent = fs.readFileSync(localScreenshotPath);
+    const remoteScreenshotPath = prefix + safeUrl + (format === "jpeg" ? ".jpg" : ".png");
     const screenshotParams = {
       Bucket: event.bucket,
       Key: remoteScreenshotPath,
-      Body: fileContent,
+      Body: screenshot,
+      ContentType: "image/" + format,
     };
-    s3.upload(screenshotParams, function (err, data) {
-      if (err) {
-        errorHandler(err, prefix, safeUrl, event);
-      }
-      result = { status: 200 };
-    });
+    checkCancelled(invocation);
+    const uploads = [s3.upload(screenshotParams).promise()];
+
+    let remoteThumbnailPath = null;
+    if (image.thumbnailWidth) {
+      // Lowering the scale factor shrinks the capture without re-laying out the page
+      const viewport = page.viewport();
+      await page.setViewport({
+        ...viewport,
+        deviceScaleFactor: image.thumbnailWidth / viewport.width,
+      });
+      const thumbnail = await page.screenshot({
+        type: "jpeg",
+        quality: image.thumbnailQuality || 60,
+      });
+      remoteThumbnailPath = prefix + safeUrl + ".thumb.jpg";
+      const thumbnailParams = {
+        Bucket: event.bucket,
+        Key: remoteThumbnailPath,
+        Body: thumbnail,
+        ContentType: "image/jpeg",
+      };
+      checkCancelled(invocation);
+      uploads.push(s3.upload(thumbnailParams).promise());
+    }
+
+    lap("screenshot");
 
     const meta = await page.$$eval("meta", (tags) => {
       let values = {};
@@ -77,53 +234,107 @@ exports.handler = async (event, context, callback) => {
     });
 
     const pageInfo = {
-      startUrl: event.url,
+      startUrl: url,
       bucket: event.bucket,
       prefix: event.prefix,
       finalUrl: page.url(),
       title: await page.title(),
-      content: await page.content(),
-      cookies: await page.cookies(),
-      meta: meta,
-      headers: httpResponse.headers(),
       ipAddress: httpResponse.remoteAddress(),
       status: {
         code: httpResponse.status(),
         text: httpResponse.statusText(),
       },
-      scripts: scripts,
+      screenshot: remoteScreenshotPath,
+      thumbnail: remoteThumbnailPath,
+      region: process.env.AWS_REGION,
+      coldStart: invocation.coldStart,
+      attempt: event.attempt || 1,
+      startedAt: startedAt,
+      timings: timings,
     };
-
-    let remotePageInfoPath = prefix + safeUrl + ".json";
-    const pageInfoParams = {
-      Bucket: event.bucket,
-      Key: remotePageInfoPath,
-      Body: JSON.stringify(pageInfo),
+    const artifact = {
+      content: await page.content(),
+      cookies: await page.cookies(),
+      meta: meta,
+      headers: httpResponse.headers(),
+      scripts: scripts,
     };
-
+    lap("extract");
+    checkCancelled(invocation);
+    const [payload] = await Promise.all([
+      offloadPage(pageInfo, artifact, prefix, safeUrl, event),
+      ...uploads,
+    ]);
+    lap("upload");
+    payload.invokedAt = Date.now();
     const invokeParams = {
       FunctionName: "Flashbulb--Analyze",
-      Payload: JSON.stringify(pageInfo),
-      InvocationType: "Event",
+      Payload: JSON.stringify(payload),
+      // Self-tests wait for the analyzed result instead of handing the page off
+      InvocationType: event.selftest ? "RequestResponse" : "Event",
     };
+    checkCancelled(invocation);
+    const response = await lambda.invoke(invokeParams).promise();
+    if (event.selftest) {
+      const analyzed = JSON.parse(response.Payload || "null");
+      if (response.FunctionError) {
+        throw new Error("Analyze failed: " + (analyzed && analyzed.errorMessage));
+      }
+      return { url: url, status: 200, result: analyzed };
+    }
+    return { url: url, status: 200 };
+  } catch (error) {
+    if (!invocation.cancelled) {
+      await errorHandler(error, url, event);
+    }
+    return { url: url, error: error.message };
+  } finally {
+    await browserContext.close();
+  }
+};
+
+exports.handler = async (event, context, callback) => {
+  // Batched invocations send a list of urls, single invocations send one url
+  const urls = event.urls || [event.url || "https://example.com"];
+  const results = [];
+  const invocation = { coldStart: coldStart, timings: {} };
+  coldStart = false;
 
-    if (Buffer.byteLength(invokeParams.Payload, "utf8") > 262144) {
-      invokeParams.InvocationType = "RequestResponse";
+  if (event.warmup || event.selftest) {
+    try {
+      const reply = event.warmup
+        ? await warmUp(event, context, invocation)
+        : await selfTest(event, context, invocation);
+      return callback(null, reply);
+    } catch (error) {
+      await closeBrowser();
+      return callback(error);
     }
+  }
 
-    lambda.invoke(invokeParams, (err, data) => {
-      if (err) {
-        errorHandler(err, prefix, safeUrl, event);
+  try {
+    const browser = await getBrowser(invocation);
+    for (const url of urls) {
+      if (context.getRemainingTimeInMillis() < MIN_REMAINING_MS) {
+        const error = new Error("Lambda time budget exhausted before target was visited");
+        await errorHandler(error, url, event, "budget");
+        results.push({ url: url, error: error.message });
+        continue;
       }
-    });
+      results.push(await screenshotTarget(browser, url, event, invocation));
+      invocation.timings = {};
+    }
   } catch (error) {
-    errorHandler(error, prefix, safeUrl, event);
+    // The browser itself failed, so every target not yet visited failed with it
+    await Promise.all(
+      urls
+        .slice(results.length)
+        .map((url) => errorHandler(error, url, event, "browser"))
+    );
+    // Start from a fresh browser on the next invocation
+    await closeBrowser();
     return callback(error);
-  } finally {
-    if (browser !== null) {
-      await browser.close();
-    }
   }
 
-  return callback(null, result);
+  return callback(null, { results: results });
 };
@@ -0,0 +1,87 @@
+// Packaged next to index.js in both functions by _tools/stage_function.py
+const AWS = require("aws-sdk");
+const s3 = new AWS.S3();
+
+const getSafeUrl = (url) => url.replace("://", "-").replace(/\//g, "__");
+
+// Completion markers sort by time so the client can list only new ones
+const writeMarker = (prefix, safeUrl, status, event) => {
+  const timestamp = String(Date.now()).padStart(13, "0");
+  const markerParams = {
+    Bucket: event.bucket,
+    Key: prefix + "_markers/" + timestamp + "-" + status + "-" + safeUrl,
+    Body: "",
+  };
+  return s3.putObject(markerParams).promise();
+};
+
+const THROTTLE_CODES = [
+  "TooManyRequestsException",
+  "ThrottlingException",
+  "Throttling",
+  "RequestLimitExceeded",
+  "SlowDown",
+];
+
+// The client retries timeout, throttle, upload, budget and browser failures
+const classifyError = (error) => {
+  const message = String(error.message || "");
+  if (THROTTLE_CODES.includes(error.code)) {
+    return "throttle";
+  }
+  // Failed S3 and Lambda calls carry the AWS SDK's code and retryable flag
+  if (error.code && error.retryable !== undefined) {
+    return "upload";
+  }
+  if (/net::ERR_NAME_(NOT_RESOLVED|RESOLUTION_FAILED)/.test(message)) {
+    return "dns";
+  }
+  if (/net::ERR_(CERT_|SSL_|BAD_SSL_)/.test(message)) {
+    return "tls";
+  }
+  if (error.name === "TimeoutError" || /net::ERR_(CONNECTION_)?TIMED_OUT/.test(message)) {
+    return "timeout";
+  }
+  if (/net::ERR_(CONNECTION_|ADDRESS_|EMPTY_RESPONSE|NETWORK_)/.test(message)) {
+    return "connection";
+  }
+  return "other";
+};
+
+// The class goes in the marker too, so the client can decide on a retry without a read.
+// Each function gets a handler that stamps its own name on the records.
+const createErrorHandler = (functionName) => (error, url, event, errorClass) => {
+  const prefix = event.prefix || "";
+  const safeUrl = getSafeUrl(url);
+  const record = {
+    url: url,
+    class: errorClass || classifyError(error),
+    message: String(error.message || error),
+    stack: error.stack,
+    function: functionName,
+    region: process.env.AWS_REGION,
+    attempt: event.attempt || 1,
+    time: new Date().toISOString(),
+  };
+  const errorParams = {
+    Bucket: event.bucket,
+    Key: prefix + "errors/" + safeUrl + ".json",
+    Body: JSON.stringify(record),
+    ContentType: "application/json",
+  };
+  return s3
+    .upload(errorParams)
+    .promise()
+    .then(() => writeMarker(prefix, safeUrl, "error." + record.class, event))
+    .catch((err) => {
+      // Where is your god now?
+    });
+};
+
+module.exports = {
+  THROTTLE_CODES,
+  classifyError,
+  createErrorHandler,
+  getSafeUrl,
+  writeMarker,
+};
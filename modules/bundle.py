@@ -0,0 +1,196 @@
+import boto3
+from array import array
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import re
+import time
+
+logger = logging.getLogger('flashbulb.bundle')
+
+BUNDLE_DIR = 'report/'
+SHARD_SIZE = 500
+UPLOAD_WORKERS = 32
+READ_SIZE = 1024 * 1024
+# Tokens found in more than this share of records get an index file of their own, so
+# their long posting lists are only downloaded when someone searches for them
+COMMON_TOKEN_RATIO = 0.2
+COMMON_TOKEN_MIN_RECORDS = 100
+# Facet values are stored one character per record, offset past control characters
+FACET_BASE = 48
+
+TOKEN = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    """Return the search tokens in a piece of text."""
+    return TOKEN.findall(str(text).lower())
+
+
+def record_tokens(record):
+    """Return the set of tokens a record can be found by."""
+    tokens = set()
+    for field in ('startUrl', 'finalUrl', 'title', 'category'):
+        tokens.update(tokenize(record.get(field) or ''))
+    for technology in record.get('technologies') or []:
+        tokens.update(tokenize(technology.get('name', '')))
+    tokens.update(tokenize((record.get('status') or {}).get('code', '')))
+    return tokens
+
+
+def cluster_token(cluster, total):
+    """Return the search token for a cluster's members.
+
+    Ids are padded to one width, since searches also match longer tokens
+    starting with the same characters.
+    """
+    return 'cluster{}'.format(str(cluster).zfill(len(str(total))))
+
+
+def index_bucket(token):
+    """Return the name of the index file holding a token."""
+    return token[:2]
+
+
+def iter_records(aws_s3, bucket, combined_key, entries):
+    """Yield parsed records from combined.json in manifest order with one streaming read."""
+    body = aws_s3.get_object(Bucket=bucket, Key=combined_key)['Body']
+    buffer = bytearray()
+    position = 0
+    for entry in entries:
+        offset, length = entry[3], entry[4]
+        while position + len(buffer) < offset + length:
+            chunk = body.read(READ_SIZE)
+            if not chunk:
+                raise ValueError('combined.json is shorter than its manifest')
+            buffer += chunk
+        start = offset - position
+        yield json.loads(buffer[start:start + length])
+        del buffer[:start + length]
+        position = offset + length
+
+
+def clusters_digest(clusters):
+    """Return a short fingerprint of a cluster assignment, or None without one."""
+    if clusters is None:
+        return None
+    return hashlib.sha256(json.dumps(clusters).encode('utf-8')).hexdigest()[:16]
+
+
+def _encode_postings(postings):
+    # Gaps between sorted ids are much shorter than the ids themselves
+    previous = 0
+    gaps = []
+    for record_id in postings:
+        gaps.append(record_id - previous)
+        previous = record_id
+    return gaps
+
+
+def build_bundle(bucket, prefix, combined_key, entries, combined_etag, clusters=None):
+    """Write paged result shards and a search index for the report page.
+
+    The page loads report/meta.json for the facets, then only the shards it is
+    about to display and the index files for the tokens being searched.
+
+    clusters optionally gives each record's near-duplicate cluster id. Records
+    then carry it, and the page can hide every cluster member but the first.
+    """
+    aws_s3 = boto3.client('s3', config=Config(max_pool_connections=UPLOAD_WORKERS + 2))
+    bundle_prefix = prefix + BUNDLE_DIR
+    try:
+        meta = json.loads(aws_s3.get_object(Bucket=bucket, Key=bundle_prefix + 'meta.json')['Body'].read())
+        if meta.get('combinedEtag') == combined_etag and meta.get('clusterDigest') == clusters_digest(clusters):
+            logger.info('Report bundle is already up to date')
+            return
+    except ClientError:
+        pass
+
+    start = time.time()
+    statuses = {}
+    categories = {}
+    status_codes = []
+    category_codes = []
+    duplicate_codes = []
+    cluster_sizes = defaultdict(int)
+    if clusters is not None:
+        for cluster in clusters:
+            if cluster is not None:
+                cluster_sizes[cluster] += 1
+    postings = defaultdict(lambda: array('I'))
+    shard = []
+    num_shards = 0
+
+    def put_json(key, data):
+        aws_s3.put_object(Bucket=bucket, Key=bundle_prefix + key,
+                          Body=json.dumps(data, separators=(',', ':')).encode('utf-8'),
+                          ContentType='application/json')
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        uploads = []
+        for record_id, record in enumerate(iter_records(aws_s3, bucket, combined_key, entries)):
+            status = (record.get('status') or {}).get('code')
+            status_codes.append(statuses.setdefault(status, len(statuses)))
+            category_codes.append(categories.setdefault(record.get('category'), len(categories)))
+            cluster = clusters[record_id] if clusters is not None else None
+            if cluster is not None:
+                record['cluster'] = cluster
+                record['clusterSize'] = cluster_sizes[cluster]
+                # Lets the page list every member of a cluster with a search
+                postings[cluster_token(cluster, len(entries))].append(record_id)
+            duplicate_codes.append(cluster is not None and cluster != record_id)
+            for token in record_tokens(record):
+                postings[token].append(record_id)
+
+            shard.append(record)
+            if len(shard) == SHARD_SIZE:
+                uploads.append(executor.submit(put_json, 'shards/{}.json'.format(num_shards), shard))
+                num_shards += 1
+                shard = []
+        if shard:
+            uploads.append(executor.submit(put_json, 'shards/{}.json'.format(num_shards), shard))
+            num_shards += 1
+
+        total = len(status_codes)
+        common_tokens = []
+        buckets = defaultdict(dict)
+        for token, ids in postings.items():
+            if total >= COMMON_TOKEN_MIN_RECORDS and len(ids) > total * COMMON_TOKEN_RATIO:
+                common_tokens.append(token)
+                uploads.append(executor.submit(put_json, 'common/{}.json'.format(token), _encode_postings(ids)))
+            else:
+                buckets[index_bucket(token)][token] = _encode_postings(ids)
+        postings.clear()
+        for name, tokens in buckets.items():
+            uploads.append(executor.submit(put_json, 'index/{}.json'.format(name), tokens))
+        for upload in uploads:
+            upload.result()
+
+    # Status codes sort numerically, anything unexpected sorts last
+    status_list = sorted(statuses, key=lambda s: (not isinstance(s, int), s if isinstance(s, int) else 0, str(s)))
+    status_remap = {statuses[s]: i for i, s in enumerate(status_list)}
+    category_list = sorted(categories, key=str)
+    category_remap = {categories[c]: i for i, c in enumerate(category_list)}
+    meta = {
+        'combinedEtag': combined_etag,
+        'total': total,
+        'shardSize': SHARD_SIZE,
+        'statuses': status_list,
+        'categories': category_list,
+        'statusCodes': ''.join(chr(FACET_BASE + status_remap[c]) for c in status_codes),
+        'categoryCodes': ''.join(chr(FACET_BASE + category_remap[c]) for c in category_codes),
+        'indexFiles': sorted(buckets),
+        'commonTokens': sorted(common_tokens),
+        'clusterDigest': clusters_digest(clusters),
+    }
+    if clusters is not None:
+        meta['duplicateCodes'] = ''.join(chr(FACET_BASE + duplicate) for duplicate in duplicate_codes)
+        meta['duplicates'] = sum(duplicate_codes)
+    # Written last so a half-built bundle is never marked current
+    put_json('meta.json', meta)
+    logger.info('Wrote {} shards and {} index files for {} results in {:.1f}s'.format(
+        num_shards, len(buckets), total, time.time() - start))
@@ -0,0 +1,198 @@
+import gzip
+import io
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+from common.utils import normalize_prefix
+from modules.bundle import BUNDLE_DIR, iter_records
+
+logger = logging.getLogger('flashbulb.cluster')
+
+HASH_CACHE_NAME = 'hashes.json.gz'
+# Screenshots whose hashes differ in at most this many of 64 bits are the same page
+MAX_DISTANCE = 4
+HASH_CHUNK = 256
+DOWNLOAD_WORKERS = 8
+
+# Set in each worker process by _init_worker
+_worker_s3 = None
+
+
+def require_numpy():
+    """Return numpy and PIL.Image, or None if they are not installed."""
+    try:
+        import numpy
+        from PIL import Image
+    except ImportError:
+        return None
+    return numpy, Image
+
+
+def _init_worker():
+    global _worker_s3
+    _worker_s3 = boto3.client('s3', config=Config(max_pool_connections=DOWNLOAD_WORKERS))
+
+
+def _load_gray(bucket, key):
+    from PIL import Image
+    try:
+        body = _worker_s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+        image = Image.open(io.BytesIO(body))
+        # JPEG decoding can skip straight to a reduced size
+        image.draft('L', (64, 64))
+        return image.convert('L').resize((9, 8), Image.BILINEAR).tobytes()
+    except (BotoCoreError, ClientError, OSError, ValueError) as e:
+        logger.debug('Could not hash {} - {}'.format(key, e))
+        return None
+
+
+def hash_images(bucket, keys):
+    """Return the 64 bit difference hash of each image, or None where it could not be read.
+
+    Images are shrunk to 9x8 grey pixels and each bit records whether a pixel is
+    brighter than its left neighbour. The comparison runs over the whole chunk
+    at once.
+    """
+    import numpy
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        pixels = list(executor.map(lambda key: _load_gray(bucket, key), keys))
+    loaded = [i for i, data in enumerate(pixels) if data is not None]
+    hashes = [None] * len(keys)
+    if not loaded:
+        return hashes
+    grid = numpy.frombuffer(b''.join(pixels[i] for i in loaded), dtype=numpy.uint8).reshape(-1, 8, 9)
+    bits = (grid[:, :, 1:] > grid[:, :, :-1]).reshape(-1, 64)
+    values = numpy.packbits(bits, axis=1).view('>u8').ravel()
+    for i, value in zip(loaded, values.tolist()):
+        hashes[i] = value
+    return hashes
+
+
+def _popcount(numpy, values):
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(values)
+    table = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+    return table[values.view(numpy.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def near_duplicate_groups(hashes, max_distance=MAX_DISTANCE):
+    """Return a component label for each hash, equal for hashes joined by near-duplicate links.
+
+    Identical hashes are merged first. The remaining distinct hashes are split
+    into max_distance + 1 blocks, so any two within max_distance bits share at
+    least one block exactly. Only hashes sharing a block value are compared.
+    """
+    import numpy
+    unique, inverse = numpy.unique(numpy.asarray(hashes, dtype=numpy.uint64), return_inverse=True)
+    parent = list(range(len(unique)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    num_blocks = max_distance + 1
+    widths = [64 // num_blocks + (1 if b < 64 % num_blocks else 0) for b in range(num_blocks)]
+    shift = 64
+    for width in widths:
+        shift -= width
+        blocks = (unique >> numpy.uint64(shift)) & numpy.uint64((1 << width) - 1)
+        order = numpy.argsort(blocks, kind='stable')
+        values, starts, counts = numpy.unique(blocks[order], return_index=True, return_counts=True)
+        for start, count in zip(starts.tolist(), counts.tolist()):
+            if count < 2:
+                continue
+            members = order[start:start + count]
+            for position in range(count - 1):
+                i = members[position]
+                others = members[position + 1:]
+                distances = _popcount(numpy, unique[others] ^ unique[i])
+                for j in others[distances <= max_distance].tolist():
+                    root_i, root_j = find(int(i)), find(j)
+                    if root_i != root_j:
+                        parent[max(root_i, root_j)] = min(root_i, root_j)
+    return [find(i) for i in inverse.tolist()]
+
+
+def _load_hash_cache(aws_s3, bucket, prefix):
+    try:
+        body = aws_s3.get_object(Bucket=bucket, Key=prefix + BUNDLE_DIR + HASH_CACHE_NAME)['Body'].read()
+        return {key: (etag, value) for key, etag, value in json.loads(gzip.decompress(body))}
+    except (ClientError, OSError, ValueError):
+        return {}
+
+
+def cluster_screenshots(bucket, prefix, combined_key, entries, max_distance=MAX_DISTANCE, workers=None):
+    """Return each result's cluster id, or None when it has no near duplicate.
+
+    A cluster's id is the position of its first result, which also serves as
+    its representative. Hashes are kept in the bundle between runs, so only new
+    or changed results have their screenshots downloaded.
+    """
+    aws_s3 = boto3.client('s3')
+    start = time.time()
+    cache = _load_hash_cache(aws_s3, bucket, prefix)
+    hashes = [None] * len(entries)
+    missing = []
+    for position, entry in enumerate(entries):
+        cached = cache.get(entry[0])
+        if cached is not None and cached[0] == entry[1]:
+            hashes[position] = cached[1]
+        else:
+            missing.append(position)
+
+    if missing:
+        needed = [entries[position] for position in missing]
+        images = [record.get('thumbnail') or record.get('screenshot')
+                  for record in iter_records(aws_s3, bucket, combined_key, needed)]
+        chunks = [(missing[i:i + HASH_CHUNK], images[i:i + HASH_CHUNK]) for i in range(0, len(missing), HASH_CHUNK)]
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker) as executor:
+            futures = [(positions, executor.submit(hash_images, bucket, [key or '' for key in keys]))
+                       for positions, keys in chunks]
+            for positions, future in futures:
+                for position, value in zip(positions, future.result()):
+                    hashes[position] = value
+        cache_body = json.dumps([[entry[0], entry[1], value] for entry, value in zip(entries, hashes)
+                                 if value is not None]).encode('utf-8')
+        aws_s3.put_object(Bucket=bucket, Key=prefix + BUNDLE_DIR + HASH_CACHE_NAME,
+                          Body=gzip.compress(cache_body), ContentType='application/gzip')
+
+    hashed = [position for position, value in enumerate(hashes) if value is not None]
+    labels = near_duplicate_groups([hashes[position] for position in hashed], max_distance) if hashed else []
+    members = defaultdict(list)
+    for position, label in zip(hashed, labels):
+        members[label].append(position)
+
+    clusters = [None] * len(entries)
+    num_clusters = 0
+    duplicates = 0
+    for positions in members.values():
+        if len(positions) < 2:
+            continue
+        num_clusters += 1
+        duplicates += len(positions) - 1
+        for position in positions:
+            clusters[position] = positions[0]
+    logger.info('Hashed {} screenshots ({} new) in {:.1f}s: {} clusters hold {} near duplicates{}'.format(
+        len(hashed), len(missing), time.time() - start, num_clusters, duplicates,
+        ', {} could not be read'.format(len(entries) - len(hashed)) if len(hashed) < len(entries) else ''))
+    return clusters
+
+
+def cluster_report(options):
+    """Rebuild the report of a prefix with near-duplicate screenshots grouped."""
+    from modules.report import run_report
+    if require_numpy() is None:
+        logger.error('Clustering needs NumPy and Pillow. Install them with: pip install numpy Pillow')
+        exit(-1)
+    options.prefix = normalize_prefix(options.prefix)
+    run_report(options.bucket, options.prefix, cluster=True, max_distance=options.max_distance)
@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+logger = logging.getLogger('flashbulb.completion')
+
+MARKER_DIR = '_markers/'
+# Markers written this long before the newest one seen are listed again on the next
+# poll, so a marker that lands slightly out of order is never skipped
+CURSOR_LAG_MS = 10000
+DELETE_BATCH = 1000
+# Failure classes that may pass on another attempt. dns, tls, connection,
+# dispatch and other failures are final as soon as they are reported.
+RETRYABLE_CLASSES = {'timeout', 'throttle', 'upload', 'budget', 'browser'}
+
+# bucket => seconds the S3 clock is ahead of the local one
+_clock_offsets = {}
+_clock_lock = threading.Lock()
+
+
+def get_safe_url(url):
+    """Return the object name the Lambda functions derive from a target URL."""
+    return url.replace('://', '-', 1).replace('/', '__')
+
+
+def _marker_key(prefix, timestamp_ms):
+    return '{}{}{:013d}'.format(prefix, MARKER_DIR, max(timestamp_ms, 0))
+
+
+def server_time(aws_s3, bucket):
+    """Return the current time by the S3 clock, which the Lambda functions' markers follow.
+
+    The offset from the local clock is read from the Date header of one
+    request per bucket. Date has whole seconds, well within CURSOR_LAG_MS.
+    """
+    with _clock_lock:
+        if bucket not in _clock_offsets:
+            try:
+                response = aws_s3.list_objects_v2(Bucket=bucket, Prefix=MARKER_DIR, MaxKeys=0)
+                date = parsedate_to_datetime(response['ResponseMetadata']['HTTPHeaders']['date'])
+                _clock_offsets[bucket] = date.timestamp() - time.time()
+            except (BotoCoreError, ClientError, KeyError, TypeError, ValueError) as e:
+                logger.warning('Could not read the S3 clock, using the local one - {}'.format(e))
+                _clock_offsets[bucket] = 0.0
+        offset = _clock_offsets[bucket]
+    return time.time() + offset
+
+
+def marker_key(prefix, safe_url, status, timestamp):
+    """Return the key of a completion marker, named like the Lambda functions name theirs."""
+    return '{}-{}-{}'.format(_marker_key(prefix, int(timestamp * 1000)), status, safe_url)
+
+
+def remove_markers(bucket, prefix):
+    """Delete every completion marker under a prefix once a run no longer needs them."""
+    aws_s3 = boto3.client('s3')
+    removed = 0
+    try:
+        for page in aws_s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix + MARKER_DIR):
+            keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            for start in range(0, len(keys), DELETE_BATCH):
+                aws_s3.delete_objects(Bucket=bucket, Delete={'Objects': keys[start:start + DELETE_BATCH], 'Quiet': True})
+            removed += len(keys)
+    except (BotoCoreError, ClientError) as e:
+        logger.warning('Could not remove completion markers under {}/{} - {}'.format(bucket, prefix, e))
+    logger.debug('Removed {} completion markers'.format(removed))
+
+
+class CompletionTracker:
+    """Follow the per-target completion markers written by the Lambda functions.
+
+    Marker keys are `<prefix>_markers/<epoch ms>-<status>-<safe url>`, so they
+    sort by completion time and each poll only lists keys after a cursor. The cost
+    of a poll is proportional to the number of new completions, not to the number
+    of objects under the prefix.
+
+    The status is `ok`, or `error.<class>` naming the kind of failure. A target
+    that is retried gets a newer marker, which replaces its earlier state.
+
+    The cursor starts from the S3 clock rather than the local one, since a
+    local clock running ahead would put it past markers still to come.
+    """
+
+    def __init__(self, bucket, prefix, started_at=None, journal=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.journal = journal
+        # safe url => (marker time, status)
+        self.state = {}
+        # safe url => failure class of targets whose latest marker is an error
+        self.failures = {}
+        self.successes = 0
+        self.errors = 0
+        self.list_calls = 0
+        self._aws_s3 = boto3.client('s3')
+        started_at = server_time(self._aws_s3, bucket) if started_at is None else started_at
+        self._newest = int(started_at * 1000)
+
+    def poll(self):
+        """Return a list of (safe url, status) pairs for targets that changed state."""
+        changed = []
+        paginator = self._aws_s3.get_paginator('list_objects_v2')
+        page_iterator = paginator.paginate(
+            Bucket=self.bucket,
+            Prefix=self.prefix + MARKER_DIR,
+            StartAfter=_marker_key(self.prefix, self._newest - CURSOR_LAG_MS)
+        )
+        for page in page_iterator:
+            self.list_calls += 1
+            for obj in page.get('Contents', []):
+                name = obj['Key'][len(self.prefix + MARKER_DIR):]
+                timestamp, status, safe_url = name.split('-', 2)
+                timestamp = int(timestamp)
+                self._newest = max(self._newest, timestamp)
+                previous = self.state.get(safe_url)
+                if previous is not None and previous[0] >= timestamp:
+                    continue
+                # Markers written before structured errors have no class
+                status, _, failure = status.partition('.')
+                if status == 'error':
+                    self.failures[safe_url] = failure or None
+                else:
+                    self.failures.pop(safe_url, None)
+                self._count(previous[1] if previous else None, -1)
+                self._count(status, 1)
+                self.state[safe_url] = (timestamp, status)
+                changed.append((safe_url, status))
+        if self.journal is not None:
+            self.journal.record_completed(changed)
+        return changed
+
+    def _count(self, status, delta):
+        if status == 'ok':
+            self.successes += delta
+        elif status == 'error':
+            self.errors += delta
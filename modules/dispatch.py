@@ -0,0 +1,295 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+from common.utils import get_function_name
+
+logger = logging.getLogger('flashbulb.dispatch')
+
+PROGRESS_INTERVAL = 5
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 0.1
+BACKOFF_MAX = 10.0
+# Used until a region has answered at least once
+INITIAL_LATENCY = 0.1
+LATENCY_WEIGHT = 0.2
+ERROR_WEIGHT = 0.1
+THROTTLE_CODES = {'TooManyRequestsException', 'ThrottlingException', 'Throttling', 'RequestLimitExceeded'}
+
+THROTTLED = 'throttled'
+RETRYABLE = 'retryable'
+FATAL = 'fatal'
+
+
+def backoff(attempt):
+    """Return a full-jitter delay in seconds before retry number attempt."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def classify_error(error):
+    """Return whether a failed invoke was throttled, may succeed on retry, or is fatal."""
+    if isinstance(error, ClientError):
+        if error.response.get('Error', {}).get('Code') in THROTTLE_CODES:
+            return THROTTLED
+        if error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500:
+            return RETRYABLE
+        return FATAL
+    if isinstance(error, BotoCoreError):
+        # Connection resets, read timeouts and the like
+        return RETRYABLE
+    return FATAL
+
+
+class RegionState:
+    """Live capacity, latency and error figures for one region.
+
+    The number of calls a region may have in flight grows with every success,
+    doubling per round trip until the first throttle and by one per round trip
+    after it, and is halved by every throttle or error.
+    """
+
+    def __init__(self, name, capacity, max_capacity):
+        self.name = name
+        self.capacity = capacity
+        self.max_capacity = max_capacity
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.latency = None
+        self.error_rate = 0.0
+        self.cooldown_until = 0.0
+        self.slow_start = True
+        self.invoked = 0
+        self.targets = 0
+        self.throttled = 0
+        self.errors = 0
+
+    def score(self, now):
+        """Return how attractive the region is for the next call, or None if it is full."""
+        if now < self.cooldown_until or self.in_flight >= self.capacity:
+            return None
+        latency = self.latency if self.latency is not None else INITIAL_LATENCY
+        return (self.capacity - self.in_flight) * max(1.0 - self.error_rate, 0.05) / latency
+
+    def start(self):
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def succeeded(self, latency, num_targets):
+        self.in_flight -= 1
+        self.invoked += 1
+        self.targets += num_targets
+        self.latency = latency if self.latency is None else \
+            (1 - LATENCY_WEIGHT) * self.latency + LATENCY_WEIGHT * latency
+        self.error_rate *= 1 - ERROR_WEIGHT
+        increase = 1.0 if self.slow_start else 1.0 / self.capacity
+        self.capacity = min(self.capacity + increase, self.max_capacity)
+
+    def failed(self, outcome, attempt):
+        self.in_flight -= 1
+        if outcome == THROTTLED:
+            self.throttled += 1
+        else:
+            self.errors += 1
+            self.error_rate = (1 - ERROR_WEIGHT) * self.error_rate + ERROR_WEIGHT
+        if outcome == FATAL:
+            return
+        self.slow_start = False
+        self.capacity = max(self.capacity / 2, 1.0)
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + backoff(attempt))
+
+
+class Dispatcher:
+    """Invoke the screenshot function with a bounded number of calls in flight.
+
+    Each region gets one long-lived Lambda client whose connection pool is sized
+    for the requested concurrency, and the blocking invoke calls run on a thread
+    pool. submit() waits while `concurrency` calls are outstanding, which keeps
+    the producer reading targets only as fast as Lambda accepts them.
+
+    Every call goes to the region with the most free capacity, weighted by its
+    recent latency and error rate. Throttled and transient failures are retried
+    with jittered backoff, usually in another region, so work drifts toward the
+    regions that are keeping up.
+
+    Invocations that fail for good are handed to the optional ErrorReporter, so
+    each of their targets gets an error record and marker like any other failure.
+
+    Clients honour the standard AWS_ENDPOINT_URL_LAMBDA variable, so the engine
+    can be pointed at a local stub such as _tools/stub_lambda.py.
+    """
+
+    def __init__(self, regions, concurrency, reporter=None):
+        # Retries are handled here so a throttled call can move to another region
+        config = Config(max_pool_connections=concurrency,
+                        retries={'total_max_attempts': 1, 'mode': 'standard'})
+        self.clients = {region: boto3.client('lambda', region_name=region, config=config)
+                        for region in regions}
+        initial_capacity = max(concurrency / len(regions), 1.0)
+        self.regions = {region: RegionState(region, initial_capacity, concurrency) for region in regions}
+        self.concurrency = concurrency
+        self.reporter = reporter
+        self.invoked = 0
+        self.targets = 0
+        self.failed = 0
+        self.failed_targets = 0
+        self.retried = 0
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._loop = None
+        self._start = None
+        self._last_progress = None
+
+    def _invoke(self, region, payload):
+        self.clients[region].invoke(
+            FunctionName=get_function_name('screenshot'),
+            InvocationType='Event',
+            Payload=json.dumps(payload).encode('utf-8')
+        )
+
+    async def _acquire_region(self, avoid=()):
+        """Wait until some region has room for another call and reserve it.
+
+        Regions in avoid are passed over unless they are the only ones.
+        """
+        candidates = [state for name, state in self.regions.items() if name not in avoid] or \
+            list(self.regions.values())
+        while True:
+            now = time.monotonic()
+            best = None
+            best_score = None
+            for state in candidates:
+                score = state.score(now)
+                if score is not None and (best_score is None or score > best_score):
+                    best, best_score = state, score
+            if best is not None:
+                best.start()
+                return best
+
+            self._changed.clear()
+            cooldowns = [state.cooldown_until for state in self.regions.values() if state.cooldown_until > now]
+            timeout = min(cooldowns) - now if cooldowns else PROGRESS_INTERVAL
+            try:
+                await asyncio.wait_for(self._changed.wait(), max(timeout, 0.01))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self, payload, num_targets, avoid):
+        loop = asyncio.get_running_loop()
+        try:
+            for attempt in range(MAX_ATTEMPTS):
+                region = await self._acquire_region(avoid)
+                started = time.monotonic()
+                try:
+                    await loop.run_in_executor(self._executor, self._invoke, region.name, payload)
+                except Exception as e:
+                    outcome = classify_error(e)
+                    region.failed(outcome, attempt)
+                    self._changed.set()
+                    if outcome == FATAL or attempt + 1 == MAX_ATTEMPTS:
+                        self.failed += 1
+                        self.failed_targets += num_targets
+                        logger.debug('Invocation in {} failed - {}'.format(region.name, e))
+                        self._report_failure(payload, e, outcome)
+                        return
+                    self.retried += 1
+                    await asyncio.sleep(backoff(attempt))
+                    continue
+
+                region.succeeded(time.monotonic() - started, num_targets)
+                self._changed.set()
+                self.invoked += 1
+                self.targets += num_targets
+                self._log_progress()
+                return
+        finally:
+            self._slots.release()
+
+    def _report_failure(self, payload, error, outcome):
+        if self.reporter is None:
+            return
+        # Throttled targets may still get through later, other failures are final
+        error_class = 'throttle' if outcome == THROTTLED else 'dispatch'
+        for url in payload['urls'] if 'urls' in payload else [payload['url']]:
+            self.reporter.report(url, 'Could not invoke the screenshot function', str(error), error_class,
+                                 payload.get('attempt', 1))
+
+    def _log_progress(self):
+        now = time.time()
+        if now - self._last_progress >= PROGRESS_INTERVAL:
+            self._last_progress = now
+            logger.info('Dispatched {} invocations covering {} targets ({:.0f}/s, {} in flight)'.format(
+                self.invoked, self.targets, self.rate(),
+                sum(state.in_flight for state in self.regions.values())))
+
+    def rate(self):
+        """Return the average number of completed invocations per second."""
+        elapsed = time.time() - self._start if self._start else 0
+        return self.invoked / elapsed if elapsed > 0 else 0.0
+
+    def _bind_loop(self):
+        # asyncio primitives belong to one event loop, and each wave of retries runs its own
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._changed = asyncio.Event()
+            self._pending = set()
+
+    async def submit(self, payload, avoid=()):
+        """Queue an invocation, waiting first if the in-flight limit is reached.
+
+        The payload carries either a single 'url' or a batch of 'urls'. Regions
+        named in avoid are only used when no other region is configured.
+        """
+        self._bind_loop()
+        if self._start is None:
+            self._start = self._last_progress = time.time()
+        await self._slots.acquire()
+        num_targets = len(payload['urls']) if 'urls' in payload else 1
+        task = asyncio.ensure_future(self._dispatch(payload, num_targets, avoid))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    def region_stats(self):
+        """Return a dict of counters and live limits for every region."""
+        return {name: {
+            'invoked': state.invoked,
+            'targets': state.targets,
+            'throttled': state.throttled,
+            'errors': state.errors,
+            'latency': state.latency,
+            'capacity': state.capacity,
+            'peak_in_flight': state.peak_in_flight,
+        } for name, state in self.regions.items()}
+
+    async def drain(self, summary=True):
+        """Wait for every outstanding invocation and log a summary.
+
+        The dispatcher can take more work afterwards, from another event loop too.
+        """
+        if self._loop is not None and self._pending:
+            await asyncio.wait(list(self._pending))
+        if not summary:
+            return
+        logger.info('Dispatched {} invocations covering {} targets at {:.0f}/s with up to {} in flight'.format(
+            self.invoked, self.targets, self.rate(), self.concurrency))
+        for name, stats in sorted(self.region_stats().items()):
+            logger.info('  {}: {} invocations, {} targets, {} throttled, {} errors, '
+                        '{:.0f} ms latency, limit {:.0f}, peak {} in flight'.format(
+                            name, stats['invoked'], stats['targets'], stats['throttled'], stats['errors'],
+                            (stats['latency'] or 0) * 1000, stats['capacity'], stats['peak_in_flight']))
+        if self.retried:
+            logger.info('{} invocations were retried after a throttle or transient error'.format(self.retried))
+        if self.failed:
+            logger.warning('{} invocations covering {} targets could not be dispatched'.format(
+                self.failed, self.failed_targets))
+
+    def close(self):
+        """Release the thread pool once no more invocations will be submitted."""
+        self._executor.shutdown()
@@ -0,0 +1,163 @@
+import hashlib
+import logging
+import sqlite3
+import time
+
+import json
+
+import boto3
+from botocore.config import Config
+
+from common.constants import CACHE_DIR
+from modules.completion import RETRYABLE_CLASSES, get_safe_url
+from modules.report import FETCH_WORKERS, fetch_ordered, list_results
+
+logger = logging.getLogger('flashbulb.journal')
+
+DISPATCHED = 'dispatched'
+OK = 'ok'
+ERROR = 'error'
+# Served from an earlier run's result instead of being dispatched
+CACHED = 'cached'
+FLUSH_SIZE = 1000
+# Stays under the 999 variable limit of older SQLite builds
+UPDATE_CHUNK = 500
+
+
+def get_journal_path(bucket, prefix):
+    """Return the default journal location for a bucket and prefix."""
+    digest = hashlib.sha256('{}/{}'.format(bucket, prefix).encode('utf-8')).hexdigest()[:16]
+    return CACHE_DIR.joinpath('journals').joinpath('{}.sqlite'.format(digest))
+
+
+class Journal:
+    """SQLite record of every target's dispatch and completion state for one run.
+
+    Targets are keyed by the safe url the Lambda functions use for object names,
+    so state can be rebuilt from what already exists in S3. Writes are buffered
+    and committed in batches.
+    """
+
+    def __init__(self, bucket, prefix, path=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.path = path or get_journal_path(bucket, prefix)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path))
+        self._db.execute('CREATE TABLE IF NOT EXISTS targets ('
+                         'safe_url TEXT PRIMARY KEY, url TEXT, state TEXT NOT NULL, updated_at REAL NOT NULL)')
+        self._pending_writes = []
+
+    def reset(self):
+        """Forget every target, warning if the previous run did not finish."""
+        unfinished = self._db.execute('SELECT COUNT(*) FROM targets WHERE state = ?', (DISPATCHED,)).fetchone()[0]
+        if unfinished:
+            logger.warning('Discarding journal of an unfinished run with {} outstanding targets. '
+                           'Use --resume to continue it instead.'.format(unfinished))
+        self._db.execute('DELETE FROM targets')
+        self._db.commit()
+
+    def _write(self, safe_url, url, state):
+        self._pending_writes.append((safe_url, url, state, time.time()))
+        if len(self._pending_writes) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self._pending_writes:
+            return
+        # A completion never goes back to dispatched, and a known url is kept
+        self._db.executemany(
+            'INSERT INTO targets (safe_url, url, state, updated_at) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(safe_url) DO UPDATE SET '
+            'url = COALESCE(excluded.url, targets.url), '
+            'state = CASE WHEN excluded.state = ? AND targets.state != ? '
+            'THEN targets.state ELSE excluded.state END, '
+            'updated_at = excluded.updated_at',
+            [write + (DISPATCHED, DISPATCHED) for write in self._pending_writes])
+        self._db.commit()
+        self._pending_writes = []
+
+    def record_dispatched(self, urls):
+        for url in urls:
+            self._write(get_safe_url(url), url, DISPATCHED)
+
+    def record_completed(self, changes):
+        """Record (safe url, status) pairs reported by the completion tracker."""
+        for safe_url, status in changes:
+            self._write(safe_url, None, status)
+
+    def record_cached(self, urls):
+        for url in urls:
+            self._write(get_safe_url(url), url, CACHED)
+
+    def completed_urls(self):
+        """Yield the urls screenshotted successfully by this run."""
+        self.flush()
+        for row in self._db.execute('SELECT url FROM targets WHERE state = ? AND url IS NOT NULL', (OK,)):
+            yield row[0]
+
+    def is_completed(self, url):
+        row = self._db.execute('SELECT state FROM targets WHERE safe_url = ?', (get_safe_url(url),)).fetchone()
+        return row is not None and row[0] != DISPATCHED
+
+    def pending(self, urls):
+        """Yield only the urls that have not completed yet."""
+        self.flush()
+        skipped = 0
+        for url in urls:
+            if self.is_completed(url):
+                skipped += 1
+                continue
+            yield url
+        logger.info('Skipped {} targets completed by an earlier attempt'.format(skipped))
+
+    def reconcile(self):
+        """Mark targets whose results or final error reports already exist in S3 as completed.
+
+        Failures of a retryable class are left pending, so the resumed run
+        dispatches them again. A result wins over an earlier error report.
+        """
+        aws_s3 = boto3.client('s3', config=Config(max_pool_connections=FETCH_WORKERS))
+        found = 0
+        records = []
+        paginator = aws_s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + 'errors/'):
+            for obj in page.get('Contents', []):
+                name = obj['Key'][len(self.prefix + 'errors/'):]
+                if name.endswith('.json'):
+                    records.append(obj)
+                elif name.endswith('.txt'):
+                    # Reports were plain text before they became structured records, with no class
+                    self._write(name[:-len('.txt')], None, ERROR)
+                    found += 1
+
+        retryable = []
+        for obj, body in fetch_ordered(aws_s3, self.bucket, records):
+            safe_url = obj['Key'][len(self.prefix + 'errors/'):-len('.json')]
+            try:
+                error_class = json.loads(body).get('class')
+            except (ValueError, AttributeError):
+                error_class = None
+            if error_class in RETRYABLE_CLASSES:
+                retryable.append(safe_url)
+            else:
+                self._write(safe_url, None, ERROR)
+                found += 1
+        self.flush()
+        # An interrupted run may already have recorded them as errors from their markers
+        for start in range(0, len(retryable), UPDATE_CHUNK):
+            chunk = retryable[start:start + UPDATE_CHUNK]
+            self._db.execute('UPDATE targets SET state = ? WHERE state = ? AND safe_url IN ({})'.format(
+                ','.join('?' * len(chunk))), [DISPATCHED, ERROR] + chunk)
+        self._db.commit()
+
+        for obj in list_results(aws_s3, self.bucket, self.prefix):
+            self._write(obj['Key'][len(self.prefix):-len('.json')], None, OK)
+            found += 1
+        self.flush()
+        logger.info('Found {} completed targets under {}/{}, {} retryable error reports'.format(
+            found, self.bucket, self.prefix, len(retryable)))
+
+    def close(self):
+        self.flush()
+        self._db.close()
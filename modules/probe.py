@@ -0,0 +1,108 @@
+import asyncio
+import errno
+import ipaddress
+import logging
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+from modules.resolve import DEFAULT_PORTS
+from modules.target_checks import ErrorReporter, map_concurrently
+
+logger = logging.getLogger('flashbulb.probe')
+
+PROBE_CONCURRENCY = 1000
+PROBE_TIMEOUT = 3.0
+PROBE_RATE = 2000
+
+REFUSED = 'refused'
+TIMED_OUT = 'timed out'
+UNREACHABLE = 'unreachable'
+# Chromium's wording for each outcome, so the report reads the same either way
+CHROMIUM_ERRORS = {
+    REFUSED: 'net::ERR_CONNECTION_REFUSED',
+    TIMED_OUT: 'net::ERR_CONNECTION_TIMED_OUT',
+    UNREACHABLE: 'net::ERR_ADDRESS_UNREACHABLE',
+}
+
+
+class RateLimiter:
+    """Space calls out evenly so no more than rate start per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        start = max(self._next, now)
+        self._next = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+def probe_endpoint(url):
+    """Return the (address, port) to probe for a target, or None if it is not an IP target."""
+    parts = urlsplit(url)
+    try:
+        address = ipaddress.ip_address(parts.hostname or '')
+    except ValueError:
+        return None
+    return str(address), parts.port or DEFAULT_PORTS.get(parts.scheme, 80)
+
+
+async def check_listener(address, port, timeout):
+    """Return None if a TCP connection to address:port succeeds, or why it failed."""
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(address, port), timeout)
+    except asyncio.TimeoutError:
+        return TIMED_OUT
+    except ConnectionRefusedError:
+        return REFUSED
+    except OSError as e:
+        return REFUSED if e.errno == errno.ECONNREFUSED else UNREACHABLE
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return None
+
+
+async def probe_targets(urls, bucket, prefix, rate=PROBE_RATE, timeout=PROBE_TIMEOUT, journal=None):
+    """Yield the urls worth dispatching after a TCP connect check of every IP target.
+
+    IP targets are probed at no more than rate new connections per second.
+    Those where nothing accepts a connection get a "no listener" error report
+    and are never dispatched. Hostname targets pass through unchecked.
+    """
+    errors = ErrorReporter(bucket, prefix, journal)
+    limiter = RateLimiter(rate)
+    counts = Counter()
+
+    async def probe(url):
+        endpoint = probe_endpoint(url)
+        if endpoint is None:
+            return endpoint, None
+        await limiter.wait()
+        return endpoint, await check_listener(endpoint[0], endpoint[1], timeout)
+
+    start = time.time()
+    try:
+        async for url, (endpoint, failure) in map_concurrently(probe, urls, PROBE_CONCURRENCY):
+            if endpoint is None:
+                counts['skipped'] += 1
+            elif failure is not None:
+                counts[failure] += 1
+                errors.report(url, CHROMIUM_ERRORS[failure],
+                              'no listener on {}:{} ({})'.format(endpoint[0], endpoint[1], failure), 'connection')
+                continue
+            else:
+                counts['open'] += 1
+            yield url
+    finally:
+        await errors.close()
+
+    probed = counts['open'] + counts[REFUSED] + counts[TIMED_OUT] + counts[UNREACHABLE]
+    logger.info('Probed {} IP targets in {:.0f}s: {} accepting connections, {} refused, {} timed out, {} unreachable'.format(
+        probed, time.time() - start, counts['open'], counts[REFUSED], counts[TIMED_OUT], counts[UNREACHABLE]))
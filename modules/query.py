@@ -0,0 +1,104 @@
+import json
+import logging
+import re
+import time
+
+from common.utils import normalize_prefix
+from modules.results_db import ResultDatabase, get_database_path, network_range
+
+logger = logging.getLogger('flashbulb.query')
+
+STATUS_RANGE = re.compile(r'^([1-5])xx$', re.IGNORECASE)
+
+
+def _like_pattern(text):
+    """Return a LIKE pattern matching text anywhere, with its wildcards taken literally."""
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return '%{}%'.format(escaped)
+
+
+def _any_of(clauses, parameters):
+    return '({})'.format(' OR '.join(clauses)), parameters
+
+
+def build_filter(options):
+    """Return a WHERE clause and its parameters for the query options.
+
+    Different filters must all match. Repeating a filter matches any of its
+    values, except for technologies and title words, which must all match.
+    """
+    clauses = []
+    parameters = []
+
+    def add(clause, values):
+        clauses.append(clause)
+        parameters.extend(values)
+
+    for technology in options.tech or []:
+        add('id IN (SELECT result_id FROM technologies WHERE name = ?)', [technology])
+    for word in options.title or []:
+        add("title LIKE ? ESCAPE '\\'", [_like_pattern(word)])
+    if options.status:
+        alternatives = []
+        values = []
+        for status in options.status:
+            match = STATUS_RANGE.match(status)
+            if match:
+                alternatives.append('status BETWEEN ? AND ?')
+                values.extend([int(match.group(1)) * 100, int(match.group(1)) * 100 + 99])
+            else:
+                alternatives.append('status = ?')
+                values.append(int(status))
+        add(*_any_of(alternatives, values))
+    if options.category:
+        add(*_any_of(['category = ? COLLATE NOCASE'] * len(options.category), options.category))
+    if options.ip:
+        values = []
+        for network in options.ip:
+            values.extend(network_range(network))
+        add(*_any_of(['ip_key BETWEEN ? AND ?'] * len(options.ip), values))
+    return ' AND '.join(clauses) or '1', parameters
+
+
+def _format_row(record):
+    status = (record.get('status') or {}).get('code')
+    technologies = ', '.join(technology.get('name', '') for technology in record.get('technologies') or [])
+    return '{:<6} {:<15} {:<50} {}{}'.format(
+        status if status is not None else '-', record.get('category') or '-',
+        (record.get('finalUrl') or record.get('startUrl') or '')[:50], (record.get('title') or '')[:40],
+        '  [{}]'.format(technologies) if technologies else '')
+
+
+def query_results(options):
+    """Print the locally synced results that match the given filters."""
+    options.prefix = normalize_prefix(options.prefix)
+    path = options.db or get_database_path(options.bucket, options.prefix)
+    if not path.exists():
+        logger.error('No local results for {}/{}. Run sync first.'.format(options.bucket, options.prefix))
+        exit(-1)
+    try:
+        where, parameters = build_filter(options)
+    except ValueError as e:
+        logger.error('Invalid filter - {}'.format(e))
+        exit(-1)
+
+    database = ResultDatabase(path)
+    start = time.time()
+    try:
+        if options.count:
+            print(database.count_where(where, parameters))
+        else:
+            shown = 0
+            for record in database.select(where, parameters, options.limit):
+                shown += 1
+                if options.output == 'json':
+                    print(json.dumps(record))
+                elif options.output == 'urls':
+                    print(record.get('startUrl'))
+                else:
+                    print(_format_row(record))
+            if options.limit and shown == options.limit:
+                logger.info('Showing the first {} matches, use --limit 0 for all'.format(shown))
+        logger.debug('Query took {:.0f} ms'.format((time.time() - start) * 1000))
+    finally:
+        database.close()
@@ -1,41 +1,254 @@
-
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from common.constants import FLASHBULB_DIR
-from pathlib import Path
-import os
-import glob
+from modules.bundle import build_bundle
 import json
-import io
-import pathlib
 import logging
+import time
 
 logger = logging.getLogger('flashbulb.report')
 
-def combine_json(bucket, prefix):
-    logger.info("Analyzing reports")
-    aws_s3 = boto3.client('s3')
+FETCH_WORKERS = 32
+# S3 requires every part but the last to be at least 5 MB
+PART_SIZE = 8 * 1024 * 1024
+COPY_PART_SIZE = 512 * 1024 * 1024
+COMBINED_NAME = 'combined.json'
+MANIFEST_NAME = 'combined.manifest.json'
+RESERVED_NAMES = {COMBINED_NAME, MANIFEST_NAME}
+
+
+def list_results(aws_s3, bucket, prefix):
+    """Yield the result objects stored directly under a prefix, in key order."""
     paginator = aws_s3.get_paginator('list_objects_v2')
     page_iterator = paginator.paginate(
         Bucket=bucket,
         Prefix=prefix
     )
+    for page in page_iterator:
+        for obj in page.get('Contents', []):
+            name = obj['Key'][len(prefix):]
+            # Errors, markers and other bookkeeping live in subdirectories
+            if name.endswith('.json') and '/' not in name and name not in RESERVED_NAMES:
+                yield obj
 
-    data = []
-    buffer = b'{"targets":['
 
-    for page in page_iterator:
-        for obj in page['Contents']:
-            if obj['Key'].endswith('.json'):
-                temp_buffer = io.BytesIO(b'')
-                aws_s3.download_fileobj(bucket, obj['Key'], temp_buffer)
-                temp_buffer.seek(0)
-                buffer += temp_buffer.getvalue()
-                buffer += b','
-    # Trailing commas aren't allowed by JSON spec
-    buffer = buffer[:-1]
-    buffer += b"]}"
-    temp_buffer = io.BytesIO(buffer)
-    aws_s3.upload_fileobj(temp_buffer, bucket, prefix + 'combined.json')  
+def _get_body(aws_s3, bucket, key):
+    return aws_s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+
+def fetch_ordered(aws_s3, bucket, objects, workers=FETCH_WORKERS):
+    """Yield (object, body) pairs in input order while fetching ahead on a worker pool."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        window = deque()
+        for obj in objects:
+            window.append((obj, executor.submit(_get_body, aws_s3, bucket, obj['Key'])))
+            if len(window) >= workers * 4:
+                obj, future = window.popleft()
+                yield obj, future.result()
+        while window:
+            obj, future = window.popleft()
+            yield obj, future.result()
+
+
+class MultipartWriter:
+    """File-like writer that streams into an S3 object part by part.
+
+    Small outputs that never fill a part are written with a single PutObject.
+    """
+
+    def __init__(self, aws_s3, bucket, key, content_type='application/json'):
+        self.aws_s3 = aws_s3
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_written += len(data)
+        if len(self._buffer) >= PART_SIZE:
+            self._flush()
+
+    def copy_range(self, source_key, start, end, etag=None):
+        """Append bytes [start, end] of another object in the bucket.
+
+        Runs of at least a full part are copied server-side. Anything shorter,
+        or needed to top up a partly filled buffer, is downloaded instead.
+        """
+        while start <= end:
+            remaining = end - start + 1
+            if not self._buffer and remaining >= PART_SIZE:
+                size = min(remaining, COPY_PART_SIZE)
+                self._copy_part(source_key, start, start + size - 1, etag)
+                self.bytes_written += size
+            else:
+                size = min(remaining, PART_SIZE - len(self._buffer))
+                response = self.aws_s3.get_object(
+                    Bucket=self.bucket, Key=source_key, Range='bytes={}-{}'.format(start, start + size - 1))
+                self.write(response['Body'].read())
+            start += size
+
+    def _start(self):
+        if self._upload_id is None:
+            response = self.aws_s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, ContentType=self.content_type)
+            self._upload_id = response['UploadId']
+
+    def _flush(self):
+        self._start()
+        part_number = len(self._parts) + 1
+        response = self.aws_s3.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            PartNumber=part_number, Body=bytes(self._buffer))
+        self._parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        self._buffer = bytearray()
+
+    def _copy_part(self, source_key, start, end, etag):
+        self._start()
+        part_number = len(self._parts) + 1
+        params = {}
+        if etag is not None:
+            params['CopySourceIfMatch'] = etag
+        response = self.aws_s3.upload_part_copy(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id, PartNumber=part_number,
+            CopySource={'Bucket': self.bucket, 'Key': source_key},
+            CopySourceRange='bytes={}-{}'.format(start, end), **params)
+        self._parts.append({'PartNumber': part_number, 'ETag': response['CopyPartResult']['ETag']})
+
+    def close(self):
+        """Finish the upload and return the ETag of the written object."""
+        if self._upload_id is None:
+            response = self.aws_s3.put_object(Bucket=self.bucket, Key=self.key,
+                                              Body=bytes(self._buffer), ContentType=self.content_type)
+            return response['ETag']
+        if self._buffer:
+            self._flush()
+        response = self.aws_s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            MultipartUpload={'Parts': self._parts})
+        return response['ETag']
+
+    def abort(self):
+        if self._upload_id is not None:
+            self.aws_s3.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+
+def load_manifest(aws_s3, bucket, prefix):
+    """Return the manifest entries and ETag of the current combined.json.
+
+    Each entry is [key, etag, size, offset, length], where offset and length locate
+    the result's bytes inside combined.json. A manifest that no longer matches
+    combined.json is ignored so the report is rebuilt from scratch.
+    """
+    try:
+        body = aws_s3.get_object(Bucket=bucket, Key=prefix + MANIFEST_NAME)['Body'].read()
+        manifest = json.loads(body)
+        combined = aws_s3.head_object(Bucket=bucket, Key=prefix + COMBINED_NAME)
+    except ClientError:
+        return [], None
+    if combined['ETag'] != manifest.get('combined_etag'):
+        logger.warning('combined.json changed since the manifest was written, rebuilding it')
+        return [], None
+    return manifest['entries'], combined['ETag']
+
+
+def plan_combine(previous, listed):
+    """Return the ordered list of steps that rebuilds combined.json.
+
+    Steps are ('copy', [entries]) for runs of unchanged results that are
+    contiguous in the previous combined.json, and ('fetch', key, etag, size) for
+    new or changed results. Existing results keep their position and new ones
+    are appended in key order.
+    """
+    plan = []
+    run = []
+    for entry in previous:
+        key, etag = entry[0], entry[1]
+        if key not in listed:
+            continue
+        if listed[key][0] == etag:
+            # Records in combined.json are separated by a single comma
+            if run and run[-1][3] + run[-1][4] + 1 != entry[3]:
+                plan.append(('copy', run))
+                run = []
+            run.append(entry)
+            continue
+        if run:
+            plan.append(('copy', run))
+            run = []
+        plan.append(('fetch', key) + listed[key])
+    if run:
+        plan.append(('copy', run))
+
+    known = {entry[0] for entry in previous}
+    for key, (etag, size) in listed.items():
+        if key not in known:
+            plan.append(('fetch', key, etag, size))
+    return plan
+
+
+def combine_json(bucket, prefix):
+    """Rebuild combined.json and return its manifest entries and ETag."""
+    logger.info("Analyzing reports")
+    aws_s3 = boto3.client('s3', config=Config(max_pool_connections=FETCH_WORKERS + 2))
+    start = time.time()
+
+    listed = {obj['Key']: (obj['ETag'], obj['Size']) for obj in list_results(aws_s3, bucket, prefix)}
+    previous, previous_etag = load_manifest(aws_s3, bucket, prefix)
+    plan = plan_combine(previous, listed)
+    if len(plan) == 1 and plan[0][0] == 'copy' and len(plan[0][1]) == len(previous):
+        logger.info('No new or changed results, combined.json is up to date')
+        return previous, previous_etag
+
+    combined_key = prefix + COMBINED_NAME
+    entries = []
+    fetched_bytes = 0
+    fetches = ({'Key': step[1]} for step in plan if step[0] == 'fetch')
+    fetched = fetch_ordered(aws_s3, bucket, fetches)
+
+    writer = MultipartWriter(aws_s3, bucket, combined_key)
+    try:
+        writer.write(b'{"targets":[')
+        for step in plan:
+            if entries:
+                writer.write(b',')
+            if step[0] == 'copy':
+                run = step[1]
+                run_start = run[0][3]
+                run_end = run[-1][3] + run[-1][4] - 1
+                base = writer.bytes_written
+                writer.copy_range(combined_key, run_start, run_end, previous_etag)
+                for key, etag, size, offset, length in run:
+                    entries.append([key, etag, size, base + offset - run_start, length])
+            else:
+                obj, body = next(fetched)
+                entries.append([step[1], step[2], step[3], writer.bytes_written, len(body)])
+                writer.write(body)
+                fetched_bytes += len(body)
+        writer.write(b']}')
+        combined_etag = writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+
+    manifest = {'combined_etag': combined_etag, 'entries': entries}
+    aws_s3.put_object(Bucket=bucket, Key=prefix + MANIFEST_NAME,
+                      Body=json.dumps(manifest).encode('utf-8'), ContentType='application/json')
+
+    num_fetched = sum(1 for step in plan if step[0] == 'fetch')
+    elapsed = max(time.time() - start, 1e-6)
+    logger.info('Combined {} results ({} reused, {} fetched, {:.1f} MB written) in {:.1f}s'.format(
+        len(entries), len(entries) - num_fetched, num_fetched, writer.bytes_written / 1e6, elapsed))
+    logger.info('Fetched {:.1f} MB at {:.0f} objects/s, {:.1f} MB/s'.format(
+        fetched_bytes / 1e6, num_fetched / elapsed, fetched_bytes / 1e6 / elapsed))
+    return entries, combined_etag
 
 
 def upload_index(bucket, prefix):
@@ -46,6 +259,15 @@ def upload_index(bucket, prefix):
     logger.info(f'Visit https://{bucket}.s3.amazonaws.com/{prefix}index.html to see the report.')
 
 
-def run_report(bucket, prefix):
-    combine_json(bucket, prefix)
+def run_report(bucket, prefix, cluster=False, max_distance=None):
+    entries, combined_etag = combine_json(bucket, prefix)
+    clusters = None
+    if cluster:
+        from modules.cluster import MAX_DISTANCE, cluster_screenshots, require_numpy
+        if require_numpy() is None:
+            logger.warning('Skipping screenshot clustering, it needs NumPy and Pillow (pip install numpy Pillow)')
+        else:
+            clusters = cluster_screenshots(bucket, prefix, prefix + COMBINED_NAME, entries,
+                                           MAX_DISTANCE if max_distance is None else max_distance)
+    build_bundle(bucket, prefix, prefix + COMBINED_NAME, entries, combined_etag, clusters)
     upload_index(bucket, prefix)
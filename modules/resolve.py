@@ -0,0 +1,275 @@
+import asyncio
+import ipaddress
+import logging
+import random
+import re
+import struct
+from collections import Counter
+from urllib.parse import urlsplit
+
+from modules.target_checks import ErrorReporter, map_concurrently
+
+logger = logging.getLogger('flashbulb.resolve')
+
+DNS_PORT = 53
+QUERY_TIMEOUT = 2.0
+# Tries per record type, each against the next resolver in the list
+QUERY_ATTEMPTS = 3
+RESOLVE_CONCURRENCY = 500
+DEFAULT_RESOLVERS = ['1.1.1.1', '8.8.8.8']
+RESOLV_CONF = '/etc/resolv.conf'
+
+TYPE_A = 1
+TYPE_AAAA = 28
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def encode_name(host):
+    """Return a hostname in DNS wire format."""
+    labels = host.rstrip('.').encode('idna').split(b'.')
+    if any(not label or len(label) > 63 for label in labels):
+        raise ValueError('Invalid hostname {}'.format(host))
+    return b''.join(bytes([len(label)]) + label for label in labels) + b'\x00'
+
+
+def build_query(query_id, host, qtype):
+    """Return a recursive query for one record type."""
+    header = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    return header + encode_name(host) + struct.pack('!HH', qtype, 1)
+
+
+def _skip_name(data, offset):
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            # A compression pointer ends the name
+            return offset + 2
+        offset += length + 1
+
+
+def parse_response(data):
+    """Return the id, response code, question and (type, ttl, data) answers of a DNS reply."""
+    query_id, flags, qdcount, ancount = struct.unpack('!HHHH', data[:8])
+    offset = 12
+    for _ in range(qdcount):
+        offset = _skip_name(data, offset) + 4
+    question = data[12:offset]
+    answers = []
+    for _ in range(ancount):
+        offset = _skip_name(data, offset)
+        rtype, rclass, ttl, length = struct.unpack('!HHIH', data[offset:offset + 10])
+        offset += 10
+        answers.append((rtype, ttl, data[offset:offset + length]))
+        offset += length
+    return query_id, flags & 0xF, question, answers
+
+
+def parse_server(server):
+    """Return (host, port) for a resolver given as an address with an optional port."""
+    match = re.fullmatch(r'\[(.+)\](?::(\d+))?', server)
+    if match:
+        return match.group(1), int(match.group(2) or DNS_PORT)
+    if server.count(':') == 1:
+        host, port = server.split(':')
+        return host, int(port)
+    return server, DNS_PORT
+
+
+def system_resolvers():
+    """Return the nameservers from resolv.conf, or public resolvers if there are none."""
+    servers = []
+    try:
+        with open(RESOLV_CONF) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    servers.append(fields[1])
+    except OSError:
+        pass
+    return servers or DEFAULT_RESOLVERS
+
+
+class DnsProtocol(asyncio.DatagramProtocol):
+    """Match UDP replies from one resolver to the queries waiting for them."""
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            query_id, rcode, question, answers = parse_response(data)
+        except (struct.error, IndexError):
+            return
+        waiting = self.pending.get(query_id)
+        # The question is echoed back, which guards against stray or spoofed replies
+        if waiting is None or waiting[0] != question.lower() or waiting[1].done():
+            return
+        waiting[1].set_result((rcode, answers))
+
+    def next_id(self):
+        while True:
+            query_id = random.getrandbits(16)
+            if query_id not in self.pending:
+                return query_id
+
+
+class Resolver:
+    """Minimal asynchronous stub resolver that sends queries to recursive resolvers over UDP.
+
+    Lookups are spread over the resolver list, cached for the life of the
+    resolver, and shared when several targets on the same host are in flight.
+    """
+
+    def __init__(self, servers=None, timeout=QUERY_TIMEOUT, attempts=QUERY_ATTEMPTS):
+        self.servers = [parse_server(server) for server in (servers or system_resolvers())]
+        self.timeout = timeout
+        self.attempts = attempts
+        self.queries = 0
+        self._cache = {}
+        self._protocols = None
+        self._open_lock = asyncio.Lock()
+        self._next_server = 0
+
+    async def _open(self):
+        async with self._open_lock:
+            if self._protocols is None:
+                loop = asyncio.get_running_loop()
+                protocols = []
+                for server in self.servers:
+                    transport, protocol = await loop.create_datagram_endpoint(DnsProtocol, remote_addr=server)
+                    protocols.append(protocol)
+                self._protocols = protocols
+
+    async def query(self, host, qtype):
+        """Return (response code, answers) for one record type, or None if no resolver answered."""
+        await self._open()
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.attempts):
+            protocol = self._protocols[self._next_server % len(self._protocols)]
+            self._next_server += 1
+            query_id = protocol.next_id()
+            query = build_query(query_id, host, qtype)
+            future = loop.create_future()
+            protocol.pending[query_id] = (query[12:].lower(), future)
+            try:
+                protocol.transport.sendto(query)
+                self.queries += 1
+                rcode, answers = await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                continue
+            finally:
+                protocol.pending.pop(query_id, None)
+            if rcode in (RCODE_NOERROR, RCODE_NXDOMAIN):
+                return rcode, answers
+        return None
+
+    async def _lookup(self, host):
+        addresses = []
+        for qtype, size in ((TYPE_A, 4), (TYPE_AAAA, 16)):
+            response = await self.query(host, qtype)
+            if response is None:
+                return None
+            rcode, answers = response
+            if rcode == RCODE_NXDOMAIN:
+                return ()
+            addresses.extend(str(ipaddress.ip_address(rdata)) for rtype, ttl, rdata in answers
+                             if rtype == qtype and len(rdata) == size)
+            if addresses:
+                break
+        return tuple(sorted(addresses))
+
+    async def resolve(self, host):
+        """Return the addresses of a host, () if it does not exist, or None if that is unknown."""
+        host = host.lower().rstrip('.')
+        entry = self._cache.get(host)
+        if isinstance(entry, asyncio.Future):
+            return await asyncio.shield(entry)
+        if entry is not None:
+            return entry
+        try:
+            encode_name(host)
+        except (ValueError, UnicodeError):
+            return None
+
+        task = asyncio.ensure_future(self._lookup(host))
+        self._cache[host] = task
+        try:
+            result = await asyncio.shield(task)
+        except BaseException:
+            self._cache.pop(host, None)
+            raise
+        # Only definite answers are kept; a timeout may succeed for the next target
+        if result is None:
+            self._cache.pop(host, None)
+        else:
+            self._cache[host] = result
+        return result
+
+    def close(self):
+        for protocol in self._protocols or []:
+            protocol.transport.close()
+        self._protocols = None
+
+
+def endpoint_key(url, addresses):
+    """Return what makes two targets the same page when they share addresses."""
+    parts = urlsplit(url)
+    return (parts.scheme, addresses, parts.port or DEFAULT_PORTS.get(parts.scheme),
+            parts.path or '/', parts.query)
+
+
+async def _resolve_url(resolver, url):
+    host = urlsplit(url).hostname
+    if host is None:
+        return host, None
+    try:
+        return host, (str(ipaddress.ip_address(host)),)
+    except ValueError:
+        pass
+    return host, await resolver.resolve(host)
+
+
+async def resolve_targets(urls, resolver, bucket, prefix, collapse=False, journal=None):
+    """Yield the urls whose hosts exist, resolving up to RESOLVE_CONCURRENCY at once.
+
+    Targets whose hosts do not exist get an error report in S3 and are never
+    dispatched. Targets whose lookup timed out are dispatched anyway. With
+    collapse, only the first target per scheme, address set, port and path is
+    yielded.
+    """
+    errors = ErrorReporter(bucket, prefix, journal)
+    endpoints = set()
+    counts = Counter()
+    try:
+        async for url, (host, addresses) in map_concurrently(
+                lambda url: _resolve_url(resolver, url), urls, RESOLVE_CONCURRENCY):
+            if addresses is None:
+                counts['unknown'] += 1
+            elif not addresses:
+                counts['unresolvable'] += 1
+                errors.report(url, 'net::ERR_NAME_NOT_RESOLVED', '{} does not exist'.format(host), 'dns')
+                continue
+            elif collapse:
+                key = endpoint_key(url, addresses)
+                if key in endpoints:
+                    counts['collapsed'] += 1
+                    continue
+                endpoints.add(key)
+            counts['dispatched'] += 1
+            yield url
+    finally:
+        resolver.close()
+        await errors.close()
+
+    logger.info('Resolved targets with {} DNS queries: {} dispatched, {} do not exist{}{}'.format(
+        resolver.queries, counts['dispatched'], counts['unresolvable'],
+        ', {} collapsed onto the same endpoint'.format(counts['collapsed']) if collapse else '',
+        ', {} could not be checked'.format(counts['unknown']) if counts['unknown'] else ''))
@@ -0,0 +1,123 @@
+import json
+import logging
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from common.constants import CACHE_DIR
+from modules.completion import get_safe_url
+
+logger = logging.getLogger('flashbulb.result_cache')
+
+COPY_WORKERS = 32
+
+
+class ResultCache:
+    """Local index of where the latest result for each normalized URL lives.
+
+    Fresh results are served into a new run by copying them server-side, so the
+    target needs no Lambda invocation at all.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or CACHE_DIR.joinpath('results.sqlite')
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path))
+        self._db.execute('CREATE TABLE IF NOT EXISTS results ('
+                         'url TEXT PRIMARY KEY, bucket TEXT NOT NULL, prefix TEXT NOT NULL, captured_at REAL NOT NULL)')
+        self._aws_s3 = None
+
+    def record(self, urls, bucket, prefix, captured_at=None):
+        """Remember that fresh results for urls now live under bucket/prefix."""
+        captured_at = time.time() if captured_at is None else captured_at
+        self._db.executemany(
+            'INSERT OR REPLACE INTO results (url, bucket, prefix, captured_at) VALUES (?, ?, ?, ?)',
+            ((url, bucket, prefix, captured_at) for url in urls))
+        self._db.commit()
+
+    def lookup(self, url, max_age):
+        """Return (bucket, prefix, captured_at) for a result newer than max_age seconds, or None."""
+        row = self._db.execute('SELECT bucket, prefix, captured_at FROM results WHERE url = ?', (url,)).fetchone()
+        if row is None or time.time() - row[2] > max_age:
+            return None
+        return row
+
+    def _copy(self, url, source_bucket, source_prefix, bucket, prefix):
+        """Copy a cached result into a new prefix and return True if it succeeded."""
+        safe_url = get_safe_url(url)
+        try:
+            record = json.loads(self._aws_s3.get_object(
+                Bucket=source_bucket, Key=source_prefix + safe_url + '.json')['Body'].read())
+            # Images are copied under the new prefix and the record repointed at them
+            for field in ('screenshot', 'thumbnail'):
+                source_key = record.get(field)
+                if not source_key:
+                    continue
+                key = prefix + source_key[len(source_prefix):]
+                self._aws_s3.copy_object(Bucket=bucket, Key=key,
+                                         CopySource={'Bucket': source_bucket, 'Key': source_key})
+                record[field] = key
+            self._aws_s3.put_object(Bucket=bucket, Key=prefix + safe_url + '.json',
+                                    Body=json.dumps(record).encode('utf-8'), ContentType='application/json')
+        except ClientError as e:
+            logger.debug('Could not reuse cached result for {} - {}'.format(url, e))
+            return False
+        return True
+
+    def serve(self, urls, bucket, prefix, max_age, journal=None):
+        """Yield the urls that need a new screenshot.
+
+        Urls with a result newer than max_age are copied into bucket/prefix
+        instead, on a worker pool. If a copy fails, the url is yielded after all.
+        """
+        self._aws_s3 = self._aws_s3 or boto3.client('s3', config=Config(max_pool_connections=COPY_WORKERS))
+        served = 0
+        copies = deque()
+
+        def finish(url, future):
+            nonlocal served
+            if not future.result():
+                return False
+            served += 1
+            if journal is not None:
+                journal.record_cached([url])
+            return True
+
+        with ThreadPoolExecutor(max_workers=COPY_WORKERS) as executor:
+            for url in urls:
+                entry = self.lookup(url, max_age)
+                if entry is None:
+                    yield url
+                elif entry[:2] == (bucket, prefix):
+                    # The result is already in place from an earlier run into this prefix
+                    served += 1
+                    if journal is not None:
+                        journal.record_cached([url])
+                else:
+                    copies.append((url, executor.submit(self._copy, url, entry[0], entry[1], bucket, prefix)))
+
+                while copies and (len(copies) > COPY_WORKERS * 4 or copies[0][1].done()):
+                    url, future = copies.popleft()
+                    if not finish(url, future):
+                        yield url
+            while copies:
+                url, future = copies.popleft()
+                if not finish(url, future):
+                    yield url
+        logger.info('Reused {} results captured within the last {}'.format(served, format_duration(max_age)))
+
+    def close(self):
+        self._db.close()
+
+
+def format_duration(seconds):
+    """Return a short human readable duration such as 24h or 90m."""
+    for suffix, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= size and seconds % size == 0:
+            return '{}{}'.format(int(seconds // size), suffix)
+    return '{}s'.format(int(seconds))
@@ -0,0 +1,144 @@
+import hashlib
+import ipaddress
+import json
+import sqlite3
+
+from common.constants import CACHE_DIR
+
+WRITE_BATCH = 2000
+# Stays under the 999 variable limit of older SQLite builds
+DELETE_CHUNK = 500
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS results ('
+    'id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE, etag TEXT NOT NULL, '
+    'start_url TEXT, final_url TEXT, host TEXT, title TEXT, status INTEGER, category TEXT, '
+    'ip TEXT, ip_key BLOB, region TEXT, record TEXT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS technologies ('
+    'result_id INTEGER NOT NULL, name TEXT NOT NULL COLLATE NOCASE, version TEXT)',
+    'CREATE INDEX IF NOT EXISTS technologies_name ON technologies (name, result_id)',
+    'CREATE INDEX IF NOT EXISTS technologies_result ON technologies (result_id)',
+    'CREATE INDEX IF NOT EXISTS results_status ON results (status)',
+    'CREATE INDEX IF NOT EXISTS results_category ON results (category)',
+    'CREATE INDEX IF NOT EXISTS results_ip ON results (ip_key)',
+    'CREATE INDEX IF NOT EXISTS results_host ON results (host)',
+]
+
+
+def get_database_path(bucket, prefix):
+    """Return the default result database location for a bucket and prefix."""
+    digest = hashlib.sha256('{}/{}'.format(bucket, prefix).encode('utf-8')).hexdigest()[:16]
+    return CACHE_DIR.joinpath('results').joinpath('{}.sqlite'.format(digest))
+
+
+def address_key(address):
+    """Return a 16 byte key that sorts IPv4 and IPv6 addresses together, or None."""
+    try:
+        address = ipaddress.ip_address(str(address).strip('[]'))
+    except ValueError:
+        return None
+    if address.version == 4:
+        address = ipaddress.IPv6Address('::ffff:' + str(address))
+    return address.packed
+
+
+def network_range(value):
+    """Return the lowest and highest address keys of an address or CIDR range."""
+    network = ipaddress.ip_network(value, strict=False)
+    return address_key(network[0]), address_key(network[-1])
+
+
+def _record_ip(record):
+    # Puppeteer reports the remote address as {ip, port}
+    address = record.get('ipAddress')
+    if isinstance(address, dict):
+        address = address.get('ip')
+    return str(address).strip('[]') if address else None
+
+
+def _record_host(record):
+    url = record.get('finalUrl') or record.get('startUrl') or ''
+    host = url.split('://', 1)[-1].split('/', 1)[0]
+    return host.rsplit('@', 1)[-1].lower() or None
+
+
+class ResultDatabase:
+    """Local SQLite copy of a prefix's results, indexed for filtering.
+
+    Each row remembers the ETag of the object it came from, so a sync only has
+    to fetch results that are new or changed since the last one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path))
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self._db.execute(statement)
+        self._next_id = (self._db.execute('SELECT MAX(id) FROM results').fetchone()[0] or 0) + 1
+        self._results = []
+        self._technologies = []
+
+    def etags(self):
+        """Return a dict of every stored key and its ETag."""
+        return dict(self._db.execute('SELECT key, etag FROM results'))
+
+    def add(self, key, etag, record):
+        """Store a result, replacing any earlier version of the same key."""
+        result_id = self._next_id
+        self._next_id += 1
+        ip = _record_ip(record)
+        status = (record.get('status') or {}).get('code')
+        self._results.append((
+            result_id, key, etag, record.get('startUrl'), record.get('finalUrl'), _record_host(record),
+            record.get('title'), status if isinstance(status, int) else None, record.get('category'),
+            ip, address_key(ip) if ip else None, record.get('region'), json.dumps(record)))
+        for technology in record.get('technologies') or []:
+            if technology.get('name'):
+                self._technologies.append((result_id, technology['name'], technology.get('version') or None))
+        if len(self._results) >= WRITE_BATCH:
+            self.flush()
+
+    def remove(self, keys):
+        """Forget the results stored under keys."""
+        self.flush()
+        self._delete(keys)
+        self._db.commit()
+
+    def _delete(self, keys):
+        for start in range(0, len(keys), DELETE_CHUNK):
+            chunk = keys[start:start + DELETE_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            self._db.execute('DELETE FROM technologies WHERE result_id IN '
+                             '(SELECT id FROM results WHERE key IN ({}))'.format(placeholders), chunk)
+            self._db.execute('DELETE FROM results WHERE key IN ({})'.format(placeholders), chunk)
+
+    def flush(self):
+        if not self._results:
+            return
+        self._delete([row[1] for row in self._results])
+        self._db.executemany('INSERT INTO results VALUES ({})'.format(','.join('?' * 13)), self._results)
+        self._db.executemany('INSERT INTO technologies VALUES (?, ?, ?)', self._technologies)
+        self._db.commit()
+        self._results = []
+        self._technologies = []
+
+    def count(self):
+        return self._db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def select(self, where, parameters, limit=None):
+        """Yield the records matching a WHERE clause over the results table."""
+        sql = 'SELECT record FROM results WHERE {} ORDER BY key'.format(where)
+        if limit:
+            sql += ' LIMIT {:d}'.format(limit)
+        for (record,) in self._db.execute(sql, parameters):
+            yield json.loads(record)
+
+    def count_where(self, where, parameters):
+        return self._db.execute('SELECT COUNT(*) FROM results WHERE {}'.format(where), parameters).fetchone()[0]
+
+    def close(self):
+        self.flush()
+        self._db.close()
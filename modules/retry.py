@@ -0,0 +1,164 @@
+import asyncio
+import heapq
+import json
+import logging
+import random
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from modules.completion import RETRYABLE_CLASSES
+from modules.dispatch import Dispatcher
+from modules.report import FETCH_WORKERS
+from modules.target_checks import ErrorReporter
+
+logger = logging.getLogger('flashbulb.retry')
+
+RETRIES = 2
+RETRY_DELAY = 15
+RETRY_DELAY_MAX = 120
+# A run may retry at most this share of its targets, so a broken run still ends quickly
+RETRY_BUDGET_RATIO = 0.2
+MIN_RETRY_BUDGET = 20
+
+
+def retry_delay(attempt):
+    """Return a jittered delay in seconds before the attempt after attempt number attempt."""
+    return random.uniform(0.5, 1.0) * min(RETRY_DELAY_MAX, RETRY_DELAY * 2 ** (attempt - 1))
+
+
+def _format_counts(counts):
+    return ', '.join('{} {}'.format(count, name) for name, count in counts.most_common())
+
+
+class RetryQueue:
+    """Dispatch targets again when their failure class may succeed on another attempt.
+
+    Error markers name the class of each failure. Retryable ones are queued with
+    exponential backoff and sent away from the region that failed them, with the
+    attempt number in the payload so the next error record carries it. Every
+    other failure is final as soon as its marker appears.
+    """
+
+    def __init__(self, options, payload, num_targets, retries=RETRIES):
+        self.options = options
+        self.payload = payload
+        self.max_attempts = retries + 1
+        self.budget = max(int(num_targets * RETRY_BUDGET_RATIO), MIN_RETRY_BUDGET)
+        # safe url => latest attempt dispatched, for retried targets only
+        self.attempts = {}
+        # Targets queued or dispatched again that have not completed since
+        self.waiting = set()
+        self.retried = Counter()
+        self.failed = Counter()
+        self.recovered = 0
+        self._due = []
+        self._budget_warned = False
+        # Created with the first wave and reused by every later one
+        self._dispatcher = None
+        self._reporter = None
+        self._aws_s3 = boto3.client('s3', config=Config(max_pool_connections=FETCH_WORKERS))
+
+    @property
+    def pending(self):
+        return len(self.waiting)
+
+    def _fetch_record(self, safe_url):
+        try:
+            response = self._aws_s3.get_object(Bucket=self.options.bucket,
+                                               Key='{}errors/{}.json'.format(self.options.prefix, safe_url))
+            return json.loads(response['Body'].read())
+        except (ClientError, ValueError) as e:
+            logger.debug('Could not read the error record of {} - {}'.format(safe_url, e))
+            return None
+
+    def update(self, changes, failures):
+        """Queue the retryable failures among the (safe url, status) changes of a tracker poll."""
+        candidates = []
+        for safe_url, status in changes:
+            self.waiting.discard(safe_url)
+            if status == 'ok':
+                if safe_url in self.attempts:
+                    self.recovered += 1
+                continue
+            failure = failures.get(safe_url) or 'unknown'
+            if failure not in RETRYABLE_CLASSES or self.attempts.get(safe_url, 1) >= self.max_attempts:
+                self.failed[failure] += 1
+                continue
+            if self.budget <= 0:
+                if not self._budget_warned:
+                    self._budget_warned = True
+                    logger.warning('Retry budget exhausted, further failures are final')
+                self.failed[failure] += 1
+                continue
+            self.budget -= 1
+            candidates.append((safe_url, failure))
+        if not candidates:
+            return
+
+        # The error record has the url and the region that failed
+        with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(candidates))) as executor:
+            records = list(executor.map(self._fetch_record, [safe_url for safe_url, _ in candidates]))
+        now = time.monotonic()
+        for (safe_url, failure), record in zip(candidates, records):
+            if record is None or not record.get('url'):
+                self.failed[failure] += 1
+                continue
+            attempt = self.attempts.get(safe_url, 1)
+            self.waiting.add(safe_url)
+            heapq.heappush(self._due, (now + retry_delay(attempt), safe_url, record['url'],
+                                       record.get('region'), failure, attempt + 1))
+
+    def dispatch_due(self):
+        """Dispatch every queued target whose backoff has elapsed and return how many there were."""
+        now = time.monotonic()
+        due = []
+        while self._due and self._due[0][0] <= now:
+            entry = heapq.heappop(self._due)
+            # A late marker from the earlier attempt may have completed it meanwhile
+            if entry[1] in self.waiting:
+                due.append(entry)
+        if due:
+            logger.info('Retrying {} targets: {}'.format(len(due), _format_counts(Counter(entry[4] for entry in due))))
+            asyncio.run(self._dispatch(due))
+        return len(due)
+
+    async def _dispatch(self, due):
+        groups = defaultdict(list)
+        for _, safe_url, url, region, failure, attempt in due:
+            self.attempts[safe_url] = attempt
+            self.retried[failure] += 1
+            groups[(region, attempt)].append(url)
+
+        batches = [(region, attempt, urls[start:start + self.options.batch_size])
+                   for (region, attempt), urls in groups.items()
+                   for start in range(0, len(urls), self.options.batch_size)]
+        if self._dispatcher is None:
+            self._reporter = ErrorReporter(self.options.bucket, self.options.prefix, stage='Not dispatched',
+                                           markers=True)
+            self._dispatcher = Dispatcher(self.options.regions, self.options.concurrency, self._reporter)
+        failed = self._dispatcher.failed
+        for region, attempt, urls in batches:
+            await self._dispatcher.submit(dict(self.payload, urls=urls, attempt=attempt),
+                                          avoid=(region,) if region else ())
+        await self._dispatcher.drain(summary=False)
+        await self._reporter.wait()
+        if self._dispatcher.failed > failed:
+            logger.warning('{} retry invocations could not be dispatched'.format(self._dispatcher.failed - failed))
+
+    def close(self):
+        """Release the clients and threads used to dispatch retries."""
+        if self._dispatcher is not None:
+            self._dispatcher.close()
+            asyncio.run(self._reporter.close())
+
+    def log_summary(self):
+        if self.retried:
+            logger.info('Made {} retries ({}), {} targets succeeded on a later attempt'.format(
+                sum(self.retried.values()), _format_counts(self.retried), self.recovered))
+        if self.failed:
+            logger.info('{} targets failed: {}'.format(sum(self.failed.values()), _format_counts(self.failed)))
@@ -1,30 +1,47 @@
 from common.constants import ENTITIES
-from common.utils import check_function, check_layer, get_function_name, get_user_response
+from common.targets import TargetFilter, host_range, normalize_url
+from common.utils import check_function, check_layer, get_credentials_id, get_user_response, load_cache, normalize_prefix, save_cache
 import boto3
-import json
+from botocore.exceptions import BotoCoreError, ClientError
 import ipaddress
+import itertools
+from modules.completion import CompletionTracker, remove_markers
+from modules.dispatch import Dispatcher
+from modules.journal import Journal
+from modules.probe import probe_targets
 from modules.report import run_report
+from modules.resolve import Resolver, resolve_targets
+from modules.result_cache import ResultCache
+from modules.retry import RetryQueue
+from modules.selftest import DEADLINE as SELFTEST_DEADLINE, test_regions
+from modules.target_checks import ErrorReporter
+from modules.warm import warm_regions
 from urllib.parse import urlparse, urlunparse
 import time
-import uuid
 import logging
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 
 logger = logging.getLogger('flashbulb.run')
 
+POLL_INTERVAL = 5
+# Seconds to wait without any new completions, plus a little per outstanding target
+BASE_TIMEOUT = 180
+TIMEOUT_PER_TARGET = 0.1
+# Regions verified this recently are not checked again
+PREFLIGHT_CACHE_TTL = 600
 
-def parse_host(line, http_and_https):
-    """Return a list of valid hosts given a line containing a URL, IP address, or CIDR."""
-    hosts = []
 
+def parse_host(line, http_and_https):
+    """Yield valid hosts given a line containing a URL, IP address, or CIDR."""
     try:
         network = ipaddress.ip_network(line)
         for ip in network.hosts():
             if http_and_https:
-                hosts.append('https://' + ip.exploded)
-            hosts.append('http://' + ip.exploded)
-        return hosts
+                yield 'https://' + ip.exploded
+            yield 'http://' + ip.exploded
+        return
     except ValueError:
         # Line is not a CIDR address, continue as normal
         pass
@@ -35,140 +52,295 @@ def parse_host(line, http_and_https):
     if http_and_https:
         url = urlparse(line)
         url = url._replace(scheme='http')
-        hosts.append(urlunparse(url))
+        yield urlunparse(url)
         url = url._replace(scheme='https')
-        hosts.append(urlunparse(url))
+        yield urlunparse(url)
     else:
-        hosts.append(line)
-
-    return hosts
-
-
-def check_regions(regions, bucket, skip_tests):
-    for region in regions:
-        logger.info("Checking region {} settings".format(region))
-        for key, entity in ENTITIES.items():
-            if entity['type'] == 'function' and not check_function(key, region):
-                logger.error(
-                    "{0} function in region {1} is out of date. Try running ./update with region {1}".format(key.title(), region))
-                exit(-1)
-            elif entity['type'] == 'layer' and not check_layer(key, region):
-                logger.error(
-                    "{0} layer in region {1} is out of date. Try running ./update with region {1}".format(key.title(), region))
-                exit(-1)
-
-        if not skip_tests:
-            if not test_screenshot(region, bucket):
-                logger.error(
-                    "Screenshot function does not appear to be working in {}. Check CloudWatch logs for more information.".format(region))
-                exit(-1)
+        yield line
+
+
+def _parse_network(line):
+    try:
+        return ipaddress.ip_network(line)
+    except ValueError:
+        return None
+
+
+def count_targets(target_list, http_and_https):
+    """Return the number of targets in a file and how many of them are URLs.
+
+    CIDR ranges are counted arithmetically, so nothing is expanded in memory.
+    """
+    schemes = 2 if http_and_https else 1
+    total = 0
+    urls = 0
+    for line in target_list:
+        line = line.strip()
+        if not line:
+            continue
+        network = _parse_network(line)
+        if network is None:
+            urls += schemes
+            total += schemes
+        else:
+            first, last = host_range(network)
+            total += (last - first + 1) * schemes
+    return total, urls
 
 
-async def invoke_screenshot(region, url, bucket, prefix):
+def iter_targets(target_list, http_and_https):
+    """Lazily yield normalized, deduplicated targets while reading the target file."""
+    schemes = ['https', 'http'] if http_and_https else ['http']
+    seen = TargetFilter()
+    try:
+        for line in target_list:
+            line = line.strip()
+            if not line:
+                continue
+            network = _parse_network(line)
+            if network is not None:
+                for scheme in schemes:
+                    for ip in seen.new_addresses(scheme, network):
+                        yield '{}://{}'.format(scheme, ip.exploded)
+                continue
+
+            for url in parse_host(line, http_and_https):
+                url = normalize_url(url)
+                if seen.add_url(url):
+                    yield url
+    finally:
+        seen.close()
+    if seen.duplicate_urls:
+        logger.info('Skipped {} duplicate URL targets'.format(seen.duplicate_urls))
+
+
+def check_region(region):
+    """Return a list of problems with the Flashbulb deployment in a region."""
     aws_lambda = boto3.client('lambda', region_name=region)
-    response = aws_lambda.invoke(
-        FunctionName=get_function_name('screenshot'),
-        InvocationType='Event',
-        Payload=json.dumps({'url': url, 'bucket': bucket,
-                            'prefix': prefix}).encode('utf-8')
-    )
-
-
-async def invoke_async(hosts, options):
-    num_regions = len(options.regions)
-    tasks = []
-    for i, url in enumerate(hosts):
-        tasks.append(asyncio.create_task(
-            invoke_screenshot(
-                options.regions[i % num_regions], url, options.bucket, options.prefix)
-        ))
-    for t in tasks:
-        await t
+    problems = []
+    for key, entity in ENTITIES.items():
+        try:
+            if entity['type'] == 'function':
+                problem = check_function(key, region, aws_lambda)
+            else:
+                problem = check_layer(key, region, aws_lambda)
+        except (BotoCoreError, ClientError) as e:
+            problem = "Could not check {} {} in {} - {}".format(key.title(), entity['type'], region, e)
+        if problem is not None:
+            problems.append(problem)
+    return problems
+
+
+def check_regions(regions, bucket, skip_tests, test_deadline=SELFTEST_DEADLINE):
+    """Check every region concurrently and exit if any of them is not ready."""
+    versions = {key: str(entity['version']) for key, entity in ENTITIES.items()}
+    cache_name = 'preflight-{}.json'.format(get_credentials_id())
+    verified = load_cache(cache_name, PREFLIGHT_CACHE_TTL) or {}
+
+    def is_verified(region):
+        entry = verified.get(region)
+        if entry is None or entry['versions'] != versions:
+            return False
+        if time.time() - entry['verified_at'] > PREFLIGHT_CACHE_TTL:
+            return False
+        return skip_tests or bucket in entry['tested_buckets']
+
+    pending = [region for region in regions if not is_verified(region)]
+    if len(pending) < len(regions):
+        logger.info("Using cached checks for {}".format(', '.join(r for r in regions if r not in pending)))
+    if not pending:
+        return
+
+    logger.info("Checking region settings in {}".format(', '.join(pending)))
+    with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+        results = dict(zip(pending, executor.map(check_region, pending)))
+
+    deployed = [region for region in pending if not results[region]]
+    if deployed and not skip_tests:
+        for region, outcome in test_regions(deployed, bucket, test_deadline).items():
+            if not outcome['ok']:
+                results[region].append(
+                    "Screenshot function does not appear to be working in {}. Check CloudWatch logs for more information.".format(region))
+
+    failed = False
+    for region in pending:
+        if results[region]:
+            failed = True
+            for problem in results[region]:
+                logger.error(problem)
+            continue
+        logger.info("Region {} is ready".format(region))
+        entry = verified.get(region)
+        tested_buckets = entry['tested_buckets'] if entry and entry['versions'] == versions else []
+        if not skip_tests and bucket not in tested_buckets:
+            tested_buckets.append(bucket)
+        verified[region] = {'versions': versions, 'tested_buckets': tested_buckets, 'verified_at': time.time()}
+
+    save_cache(cache_name, verified)
+    if failed:
+        exit(-1)
+
+
+def batched(iterable, size):
+    """Yield lists of up to size items from an iterable without reading ahead."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+async def batched_async(iterable, size):
+    """Like batched(), for targets produced by an async generator."""
+    batch = []
+    async for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def image_options(options):
+    """Return the screenshot encoding settings sent to the screenshot function."""
+    return {
+        'format': options.image_format,
+        'quality': options.image_quality,
+        'thumbnailWidth': options.thumbnail_width
+    }
+
+
+def base_payload(options):
+    """Return the payload fields shared by every invocation of a run."""
+    return {
+        'bucket': options.bucket,
+        'prefix': options.prefix,
+        'image': image_options(options)
+    }
+
+
+async def invoke_async(hosts, options, journal=None):
+    """Dispatch targets as they are produced and return the number dispatched.
+
+    Targets whose invocation failed count as dispatched, since they get an
+    error marker instead of a result.
+    """
+    reporter = ErrorReporter(options.bucket, options.prefix, journal, stage='Not dispatched', markers=True)
+    dispatcher = Dispatcher(options.regions, options.concurrency, reporter)
+
+    async def submit(urls):
+        if journal is not None:
+            journal.record_dispatched(urls)
+        await dispatcher.submit(dict(base_payload(options), urls=urls))
+
+    # Targets arrive from an async generator when they are resolved first
+    if hasattr(hosts, '__aiter__'):
+        async for urls in batched_async(hosts, options.batch_size):
+            await submit(urls)
+    else:
+        for urls in batched(hosts, options.batch_size):
+            await submit(urls)
+    await dispatcher.drain()
+    dispatcher.close()
+    await reporter.close()
+    return dispatcher.targets + dispatcher.failed_targets
 
 
 def invoke_flashbulb(options):
-    if options.prefix.startswith('/'):
-        options.prefix = options.prefix[1:]
-    if not options.prefix.endswith('/') and len(options.prefix) > 0:
-        options.prefix += '/'
+    options.prefix = normalize_prefix(options.prefix)
 
     logger.info("Flashbulb is warming up.")
 
-    hosts = []
-    for line in options.target_list.readlines():
-        line = line.strip()
-        if not line:
-            continue
-        hosts.extend(parse_host(line, options.http_and_https))
+    num_hosts, _ = count_targets(options.target_list, options.http_and_https)
     user_input = get_user_response(
-        'Flashbulb found {} potential targets. Continue? (y/N)'.format(len(hosts)), ['y', 'n'], 'n')
+        'Flashbulb found {} potential targets. Continue? (y/N)'.format(num_hosts), ['y', 'n'], 'n')
     if user_input == 'n':
         exit(0)
 
-    # Dedupe
-    hosts = list(set(hosts))
-
     if options.skip_tests:
         logger.warning("Skipping active screenshot function tests.")
-    check_regions(options.regions, options.bucket, options.skip_tests)
+    check_regions(options.regions, options.bucket, options.skip_tests, options.test_deadline)
     logger.info("Checks complete. Safety goggles on!")
+    if options.prewarm:
+        warm_regions(options.regions, options.prewarm)
 
-    asyncio.run(invoke_async(hosts, options))
-
-    wait_for_completion(options.bucket, options.prefix, len(hosts))
-    run_report(options.bucket, options.prefix)
-
-
-def get_object_count(bucket, prefix):
-    """Return the total number of objects with the given prefix in the given bucket."""
-    aws_s3 = boto3.client('s3')
-    response = aws_s3.list_objects_v2(
-        Bucket=bucket,
-        Prefix=prefix
-    )
-    total_objects = response['KeyCount']
-    while response['IsTruncated']:
-        response = aws_s3.list_objects_v2(
-            Bucket=bucket,
-            Prefix=prefix,
-            ContinuationToken=response['NextContinuationToken']
-        )
-        total_objects += response['KeyCount']
-    return total_objects
-
-
-def wait_for_completion(bucket, prefix, num_targets, silent=False):
-    timeout = 180
-    start = time.time()
-    while time.time() - start < timeout:
-        total_objects = get_object_count(bucket, prefix)
-        errors = get_object_count(bucket, prefix + 'errors')
-        successes = (total_objects - errors) // 2
-        if not silent:
-            logger.info('Status: {} successful, {} errored, {} remaining'.format(
-                successes, errors, num_targets - successes - errors))
-        if successes + errors < num_targets:
-            time.sleep(5)
+    journal = Journal(options.bucket, options.prefix, options.journal)
+    result_cache = ResultCache()
+    try:
+        if options.resume:
+            journal.reconcile()
         else:
+            journal.reset()
+
+        # Targets are read, deduped and dispatched as a stream. Seen URLs spill to a
+        # temporary table on disk and IP ranges are kept as one entry per range.
+        options.target_list.seek(0)
+        hosts = iter_targets(options.target_list, options.http_and_https)
+        if options.resume:
+            hosts = journal.pending(hosts)
+        if options.max_age is not None:
+            hosts = result_cache.serve(hosts, options.bucket, options.prefix, options.max_age, journal)
+        if options.resolve or options.collapse_endpoints:
+            hosts = resolve_targets(hosts, Resolver(options.resolvers), options.bucket, options.prefix,
+                                    options.collapse_endpoints, journal)
+        if options.probe:
+            hosts = probe_targets(hosts, options.bucket, options.prefix, options.probe_rate,
+                                  options.probe_timeout, journal)
+        tracker = CompletionTracker(options.bucket, options.prefix, journal=journal)
+        num_targets = asyncio.run(invoke_async(hosts, options, journal))
+        journal.flush()
+
+        retries = RetryQueue(options, base_payload(options), num_targets, options.retries) if options.retries else None
+        wait_for_completion(options.bucket, options.prefix, num_targets, tracker=tracker, retries=retries)
+        if retries is not None:
+            retries.log_summary()
+            retries.close()
+        result_cache.record(journal.completed_urls(), options.bucket, options.prefix)
+        # Results and error records are all later runs need, --resume included
+        remove_markers(options.bucket, options.prefix)
+    finally:
+        journal.close()
+        result_cache.close()
+    run_report(options.bucket, options.prefix, cluster=options.cluster)
+
+
+def completion_timeout(outstanding):
+    """Return how long to wait without progress before giving up on outstanding targets."""
+    return BASE_TIMEOUT + outstanding * TIMEOUT_PER_TARGET
+
+
+def wait_for_completion(bucket, prefix, num_targets, silent=False, tracker=None, retries=None):
+    """Poll until every target has completed, re-dispatching retryable failures if given a RetryQueue."""
+    if tracker is None:
+        tracker = CompletionTracker(bucket, prefix)
+    last_progress = time.time()
+    while True:
+        changes = tracker.poll()
+        if changes:
+            last_progress = time.time()
+        if retries is not None:
+            retries.update(changes, tracker.failures)
+            if retries.dispatch_due():
+                last_progress = time.time()
+        # Failures waiting for another attempt are not final yet
+        retrying = retries.pending if retries is not None else 0
+        successes, errors = tracker.successes, tracker.errors - retrying
+        remaining = num_targets - successes - errors
+        if not silent:
+            logger.info('Status: {} successful, {} errored, {} remaining{}'.format(
+                successes, errors, remaining, ' ({} being retried)'.format(retrying) if retrying else ''))
+        if remaining <= 0:
             if not silent:
                 logger.info("All targets accounted for")
                 if errors:
-                    logger.info(f'Error reports are available in {bucket}/{prefix}.')
+                    logger.info(f'Error reports are available in {bucket}/{prefix}errors/.')
             return True
+        if time.time() - last_progress > completion_timeout(remaining):
+            break
+        time.sleep(POLL_INTERVAL)
     if not silent:
         logger.error("Timeout while waiting for target completion. Some may have failed.")
     return False
 
-
-def test_screenshot(region, bucket):
-    """Test screenshot lambda is working and can upload to the specified bucket"""
-    prefix = str(uuid.uuid4()) + "/"
-    asyncio.run(invoke_screenshot(region, 'https://example.com', bucket, prefix))
-    result = wait_for_completion(bucket, prefix, 1, True)
-    if result:
-        aws_s3 = boto3.client('s3')
-        aws_s3.delete_object(Bucket=bucket, Key=prefix +
-                             'https-example.com.png')
-        aws_s3.delete_object(Bucket=bucket, Key=prefix +
-                             'https-example.com.json')
-    return result
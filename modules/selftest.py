@@ -0,0 +1,113 @@
+import json
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError, ReadTimeoutError
+
+from common.utils import get_function_name
+
+logger = logging.getLogger('flashbulb.selftest')
+
+SELFTEST_URL = 'https://example.com'
+# Seconds the screenshot function has to launch the browser, visit the page and get it analyzed
+DEADLINE = 45
+# Added to the deadline for the invoke itself before the client gives up waiting
+INVOKE_SLACK = 15
+# Writes a cancelled test had already started land within this many seconds
+CLEANUP_GRACE = 5
+
+
+def _failure(region, start, error):
+    return {'region': region, 'ok': False, 'seconds': time.time() - start, 'error': error}
+
+
+def self_test(region, bucket, prefix, deadline=DEADLINE):
+    """Run one target through both functions in a region and return how it went.
+
+    The screenshot function is invoked synchronously and waits for the analyze
+    function in turn, so the reply carries the analyzed result.
+    """
+    config = Config(read_timeout=deadline + INVOKE_SLACK, retries={'total_max_attempts': 1, 'mode': 'standard'})
+    aws_lambda = boto3.client('lambda', region_name=region, config=config)
+    start = time.time()
+    try:
+        response = aws_lambda.invoke(
+            FunctionName=get_function_name('screenshot'),
+            InvocationType='RequestResponse',
+            Payload=json.dumps({'url': SELFTEST_URL, 'bucket': bucket, 'prefix': prefix,
+                                'selftest': {'deadlineMs': int(deadline * 1000)}}).encode('utf-8')
+        )
+        reply = json.loads(response['Payload'].read() or b'null')
+    except ReadTimeoutError:
+        return _failure(region, start, 'No reply within {:.0f}s'.format(deadline + INVOKE_SLACK))
+    except (BotoCoreError, ClientError, ValueError) as e:
+        return _failure(region, start, str(e))
+
+    if response.get('FunctionError') or not isinstance(reply, dict):
+        return _failure(region, start, reply.get('errorMessage') if isinstance(reply, dict) else str(reply))
+    if reply.get('error') or not isinstance(reply.get('result'), dict):
+        return _failure(region, start, reply.get('error') or 'No analyzed result in reply')
+    result = reply['result']
+    return {
+        'region': region,
+        'ok': True,
+        'seconds': time.time() - start,
+        'launch_ms': reply.get('launchMs'),
+        'cold_start': bool(reply.get('coldStart')),
+        'status': (result.get('status') or {}).get('code'),
+        'technologies': len(result.get('technologies') or []),
+    }
+
+
+def _remove_test_objects(bucket, prefix):
+    aws_s3 = boto3.client('s3')
+    try:
+        for page in aws_s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if objects:
+                aws_s3.delete_objects(Bucket=bucket, Delete={'Objects': objects})
+    except (BotoCoreError, ClientError) as e:
+        logger.warning('Could not remove self-test objects under {}/{} - {}'.format(bucket, prefix, e))
+
+
+def log_summary(outcomes):
+    """Log one line per region with its health and latency."""
+    logger.info('{:<16} {:<7} {:>7} {:>7} {:<5} {}'.format('Region', 'Result', 'Total', 'Launch', 'Cold', 'Detail'))
+    for outcome in outcomes:
+        if outcome['ok']:
+            launch = outcome['launch_ms']
+            detail = 'HTTP {}, {} technologies'.format(outcome['status'], outcome['technologies'])
+            logger.info('{:<16} {:<7} {:>6.1f}s {:>7} {:<5} {}'.format(
+                outcome['region'], 'ok', outcome['seconds'],
+                '{:.1f}s'.format(launch / 1000) if launch is not None else '-',
+                'yes' if outcome['cold_start'] else 'no', detail))
+        else:
+            logger.info('{:<16} {:<7} {:>6.1f}s {:>7} {:<5} {}'.format(
+                outcome['region'], 'FAILED', outcome['seconds'], '-', '-', outcome['error']))
+
+
+def test_regions(regions, bucket, deadline=DEADLINE):
+    """Self-test every region at once and return each region's outcome."""
+    prefix = '{}/'.format(uuid.uuid4())
+    logger.info('Testing the screenshot function in {}'.format(', '.join(regions)))
+    try:
+        with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+            outcomes = list(executor.map(
+                lambda region: self_test(region, bucket, '{}{}/'.format(prefix, region), deadline), regions))
+        # A test that missed its deadline stops before its next write, but not during one
+        if not all(outcome['ok'] for outcome in outcomes):
+            time.sleep(CLEANUP_GRACE)
+    finally:
+        _remove_test_objects(bucket, prefix)
+    log_summary(outcomes)
+    return {outcome['region']: outcome for outcome in outcomes}
+
+
+def selftest(options):
+    outcomes = test_regions(options.regions, options.bucket, options.deadline)
+    if not all(outcome['ok'] for outcome in outcomes.values()):
+        exit(-1)
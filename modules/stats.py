@@ -0,0 +1,129 @@
+import boto3
+from botocore.config import Config
+from array import array
+from collections import defaultdict
+import heapq
+import json
+import logging
+import math
+
+from common.utils import normalize_prefix
+from modules.bundle import iter_records
+from modules.report import COMBINED_NAME, FETCH_WORKERS, fetch_ordered, list_results, load_manifest
+
+logger = logging.getLogger('flashbulb.stats')
+
+# Stages in the order a target passes through them
+STAGES = ['launch', 'context', 'dns', 'connect', 'ttfb', 'navigation', 'screenshot', 'extract', 'upload',
+          'queue', 'load', 'database', 'analyze', 'total']
+PERCENTILES = [50, 95, 99]
+
+
+def percentile(values, p):
+    """Return the nearest-rank percentile of a sorted sequence."""
+    if not values:
+        return None
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def iter_results(aws_s3, bucket, prefix):
+    """Yield every result record under a prefix.
+
+    When combined.json is current, it is read with a single request. Otherwise
+    each result is fetched on its own.
+    """
+    listed = {obj['Key']: obj['ETag'] for obj in list_results(aws_s3, bucket, prefix)}
+    entries, combined_etag = load_manifest(aws_s3, bucket, prefix)
+    if entries and len(entries) == len(listed) and all(listed.get(entry[0]) == entry[1] for entry in entries):
+        yield from iter_records(aws_s3, bucket, prefix + COMBINED_NAME, entries)
+        return
+    if entries:
+        logger.info('combined.json is out of date, fetching {} results one by one'.format(len(listed)))
+    for obj, body in fetch_ordered(aws_s3, bucket, ({'Key': key} for key in listed)):
+        yield json.loads(body)
+
+
+class StageStats:
+    """Collect stage timings for one group of targets."""
+
+    def __init__(self):
+        self.count = 0
+        self.cold_starts = 0
+        self.timings = defaultdict(lambda: array('d'))
+
+    def add(self, record):
+        self.count += 1
+        if any((record.get('coldStart') or {}).values()):
+            self.cold_starts += 1
+        for stage, value in record['timings'].items():
+            if isinstance(value, (int, float)):
+                self.timings[stage].append(value)
+
+    def summary(self, stage):
+        """Return the PERCENTILES of a stage's timings."""
+        values = sorted(self.timings.get(stage, []))
+        return [percentile(values, p) for p in PERCENTILES]
+
+
+def _format_ms(value):
+    return '-' if value is None else '{:.0f}'.format(value)
+
+
+def _log_groups(title, groups):
+    logger.info('')
+    logger.info('{:<24} {:>8} {:>7} {:>9} {:>9} {:>9}'.format(title, 'targets', 'cold', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, stats in sorted(groups.items(), key=lambda item: str(item[0])):
+        logger.info('{:<24} {:>8} {:>6.0%} {:>9} {:>9} {:>9}'.format(
+            str(name), stats.count, stats.cold_starts / stats.count,
+            *[_format_ms(value) for value in stats.summary('total')]))
+
+
+def show_stats(options):
+    """Print timing percentiles per stage, region and status, and the slowest targets."""
+    options.prefix = normalize_prefix(options.prefix)
+    aws_s3 = boto3.client('s3', config=Config(max_pool_connections=FETCH_WORKERS + 2))
+
+    overall = StageStats()
+    regions = defaultdict(StageStats)
+    statuses = defaultdict(StageStats)
+    slowest = []
+    untimed = 0
+    for record in iter_results(aws_s3, options.bucket, options.prefix):
+        if not isinstance(record.get('timings'), dict):
+            untimed += 1
+            continue
+        overall.add(record)
+        regions[record.get('region') or 'unknown'].add(record)
+        statuses[(record.get('status') or {}).get('code')].add(record)
+        total = record['timings'].get('total')
+        if isinstance(total, (int, float)):
+            # A min-heap holding the slowest targets seen so far
+            entry = (total, record.get('startUrl') or '', record['timings'])
+            if len(slowest) < options.top:
+                heapq.heappush(slowest, entry)
+            elif total > slowest[0][0]:
+                heapq.heapreplace(slowest, entry)
+
+    if untimed:
+        logger.info('{} results were captured by functions that did not record timings'.format(untimed))
+    if not overall.count:
+        logger.error('No results with timings found in {}/{}'.format(options.bucket, options.prefix))
+        exit(-1)
+
+    logger.info('{} targets, {:.0%} in a cold container'.format(overall.count, overall.cold_starts / overall.count))
+    logger.info('{:<12} {:>9} {:>9} {:>9}'.format('stage', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for stage in STAGES:
+        if stage in overall.timings:
+            logger.info('{:<12} {:>9} {:>9} {:>9}'.format(
+                stage, *[_format_ms(value) for value in overall.summary(stage)]))
+
+    _log_groups('region', regions)
+    _log_groups('status', statuses)
+
+    logger.info('')
+    logger.info('Slowest targets:')
+    for total, url, timings in sorted(slowest, reverse=True):
+        stages = {stage: value for stage, value in timings.items() if stage != 'total' and isinstance(value, (int, float))}
+        worst = max(stages, key=stages.get) if stages else None
+        logger.info('{:>9} ms  {}{}'.format(
+            _format_ms(total), url, '  (mostly {}, {} ms)'.format(worst, _format_ms(stages[worst])) if worst else ''))
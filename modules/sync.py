@@ -0,0 +1,69 @@
+import json
+import logging
+import time
+
+import boto3
+from botocore.config import Config
+
+from common.utils import normalize_prefix
+from modules.bundle import iter_records
+from modules.report import COMBINED_NAME, FETCH_WORKERS, fetch_ordered, list_results, load_manifest
+from modules.results_db import ResultDatabase, get_database_path
+
+logger = logging.getLogger('flashbulb.sync')
+
+PROGRESS_INTERVAL = 10000
+# Below this many results, fetching them one by one beats reading all of combined.json
+COMBINED_MIN_RESULTS = 1000
+
+
+def sync_results(options):
+    """Bring the local result database of a prefix up to date with S3."""
+    options.prefix = normalize_prefix(options.prefix)
+    aws_s3 = boto3.client('s3', config=Config(max_pool_connections=options.workers + 2))
+    database = ResultDatabase(options.db or get_database_path(options.bucket, options.prefix))
+    start = time.time()
+    try:
+        stored = database.etags()
+        listed = {obj['Key']: obj['ETag'] for obj in list_results(aws_s3, options.bucket, options.prefix)}
+        wanted = {key: etag for key, etag in listed.items() if stored.get(key) != etag}
+        removed = [key for key in stored if key not in listed]
+        logger.info('{} results under {}/{}: {} new, {} changed, {} removed, {} unchanged'.format(
+            len(listed), options.bucket, options.prefix, sum(1 for key in wanted if key not in stored),
+            sum(1 for key in wanted if key in stored), len(removed), len(listed) - len(wanted)))
+
+        if removed:
+            database.remove(removed)
+
+        synced = 0
+        # combined.json holds current copies of most results when the report is fresh
+        entries, _ = load_manifest(aws_s3, options.bucket, options.prefix) \
+            if len(wanted) >= COMBINED_MIN_RESULTS else ([], None)
+        entries = [entry for entry in entries if wanted.get(entry[0]) == entry[1]]
+        if len(entries) >= COMBINED_MIN_RESULTS:
+            logger.info('Reading {} results from combined.json'.format(len(entries)))
+            # iter_records streams through the file, skipping the entries that are not needed
+            for entry, record in zip(entries, iter_records(aws_s3, options.bucket,
+                                                           options.prefix + COMBINED_NAME, entries)):
+                database.add(entry[0], entry[1], record)
+                del wanted[entry[0]]
+                synced += 1
+                if synced % PROGRESS_INTERVAL == 0:
+                    logger.info('Synced {} results'.format(synced))
+
+        objects = ({'Key': key, 'ETag': etag} for key, etag in wanted.items())
+        for obj, body in fetch_ordered(aws_s3, options.bucket, objects, options.workers):
+            try:
+                record = json.loads(body)
+            except ValueError:
+                logger.warning('Skipping {}, it is not valid JSON'.format(obj['Key']))
+                continue
+            database.add(obj['Key'], obj['ETag'], record)
+            synced += 1
+            if synced % PROGRESS_INTERVAL == 0:
+                logger.info('Synced {} results'.format(synced))
+        database.flush()
+        logger.info('Synced {} results in {:.1f}s, {} in {}'.format(
+            synced, time.time() - start, database.count(), database.path))
+    finally:
+        database.close()
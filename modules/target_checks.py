@@ -0,0 +1,129 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+
+from modules.completion import get_safe_url, marker_key, server_time
+from modules.journal import ERROR
+
+logger = logging.getLogger('flashbulb.target_checks')
+
+UPLOAD_WORKERS = 16
+
+
+async def map_concurrently(function, items, limit):
+    """Yield (item, result) pairs as the coroutine function(item) completes for each item.
+
+    At most limit calls run at once. Items may come from a plain or an async
+    iterable, so checks can be chained.
+    """
+    is_async = hasattr(items, '__aiter__')
+    iterator = items.__aiter__() if is_async else iter(items)
+    running = {}
+    fetching = None
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and fetching is None and len(running) < limit:
+                if is_async:
+                    fetching = asyncio.ensure_future(iterator.__anext__())
+                    break
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                running[asyncio.ensure_future(function(item))] = item
+            if not running and fetching is None:
+                return
+
+            waiting = set(running) if fetching is None else set(running) | {fetching}
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is fetching:
+                    fetching = None
+                    try:
+                        item = task.result()
+                    except StopAsyncIteration:
+                        exhausted = True
+                        continue
+                    running[asyncio.ensure_future(function(item))] = item
+                else:
+                    yield running.pop(task), task.result()
+    finally:
+        for task in list(running) + ([fetching] if fetching is not None else []):
+            task.cancel()
+
+
+class ErrorReporter:
+    """Write error reports for targets that fail before the Lambda functions see them.
+
+    Reports land in errors/ as the same records the Lambda functions write.
+    Targets that fail a check before dispatch get no completion marker, since
+    the run never counts them. Targets whose invocation failed were counted, so
+    with markers=True they also get an error marker, as if a function had
+    reported them.
+    """
+
+    def __init__(self, bucket, prefix, journal=None, stage='Checked before dispatch', markers=False):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.journal = journal
+        self.stage = stage
+        self.markers = markers
+        self._aws_s3 = boto3.client('s3', config=Config(max_pool_connections=UPLOAD_WORKERS))
+        self._executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+        # Only uploads still running are kept, so a run with many failures stays flat
+        self._uploads = set()
+        self._lock = threading.Lock()
+
+    def _put(self, url, body, error_class):
+        safe_url = get_safe_url(url)
+        self._aws_s3.put_object(Bucket=self.bucket, Key='{}errors/{}.json'.format(self.prefix, safe_url),
+                                Body=body.encode('utf-8'), ContentType='application/json')
+        if self.markers:
+            key = marker_key(self.prefix, safe_url, 'error.' + error_class, server_time(self._aws_s3, self.bucket))
+            self._aws_s3.put_object(Bucket=self.bucket, Key=key, Body=b'')
+
+    def report(self, url, error, detail, error_class, attempt=0):
+        """Record a target as failed, worded like the matching Chromium error."""
+        body = json.dumps({
+            'url': url,
+            'class': error_class,
+            'message': '{} at {}'.format(error, url),
+            'detail': '{}: {}'.format(self.stage, detail),
+            'function': None,
+            'region': None,
+            'attempt': attempt,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        })
+        future = self._executor.submit(self._put, url, body, error_class)
+        with self._lock:
+            self._uploads.add(future)
+        future.add_done_callback(self._finished)
+        if self.journal is not None:
+            self.journal.record_completed([(get_safe_url(url), ERROR)])
+
+    def _finished(self, future):
+        with self._lock:
+            self._uploads.discard(future)
+        if future.exception() is not None:
+            logger.warning('Could not write an error report - {}'.format(future.exception()))
+
+    async def wait(self):
+        """Wait for the reports written so far."""
+        with self._lock:
+            uploads = list(self._uploads)
+        await asyncio.gather(*(asyncio.wrap_future(future) for future in uploads), return_exceptions=True)
+
+    async def close(self):
+        """Wait for every report to be written."""
+        try:
+            await self.wait()
+        finally:
+            self._executor.shutdown()
@@ -2,7 +2,7 @@ import logging
 import argparse
 
 from common.constants import  FLASHBULB_DIR, ENTITIES
-from common.utils import SemanticVersion,check_function, check_layer, get_function_name, get_function_s3_key, get_layer_name, get_layer_s3_key
+from common.utils import SemanticVersion, check_layer, get_function_name, get_function_s3_key, get_layer_name, get_layer_s3_key
 import boto3
 import asyncio
 from botocore.exceptions import ClientError
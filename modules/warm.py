@@ -0,0 +1,95 @@
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+from common.utils import get_function_name
+from modules.dispatch import THROTTLE_CODES
+
+logger = logging.getLogger('flashbulb.warm')
+
+# How long each ping holds on to its container, so that concurrent pings cannot share one
+HOLD_MS = 3000
+# A cold container unpacks and launches chromium before it answers
+PING_TIMEOUT = 120
+MAX_PINGS_IN_FLIGHT = 500
+
+
+def ping(aws_lambda, hold_ms):
+    """Send one warm-up ping to the screenshot function and return its reply."""
+    response = aws_lambda.invoke(
+        FunctionName=get_function_name('screenshot'),
+        InvocationType='RequestResponse',
+        Payload=json.dumps({'warmup': {'holdMs': hold_ms}}).encode('utf-8')
+    )
+    reply = json.loads(response['Payload'].read() or b'null')
+    if response.get('FunctionError') or not isinstance(reply, dict) or 'containerId' not in reply:
+        raise ValueError('Unexpected warm-up reply {}'.format(reply))
+    return reply
+
+
+def _ping_outcome(aws_lambda, hold_ms):
+    try:
+        return ping(aws_lambda, hold_ms)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in THROTTLE_CODES:
+            return 'throttled'
+        logger.debug('Warm-up ping failed - {}'.format(e))
+        return 'failed'
+    except (BotoCoreError, ValueError) as e:
+        logger.debug('Warm-up ping failed - {}'.format(e))
+        return 'failed'
+
+
+def warm_regions(regions, containers, hold_ms=HOLD_MS):
+    """Start the given number of screenshot containers per region and return what each region reached.
+
+    All pings are sent at once. Each one starts the browser and then holds its
+    container for hold_ms, so Lambda has to give every ping a container of its
+    own. The distinct container ids in the replies are the containers that are
+    warm afterwards.
+    """
+    config = Config(max_pool_connections=containers, read_timeout=PING_TIMEOUT,
+                    retries={'total_max_attempts': 1, 'mode': 'standard'})
+    clients = {region: boto3.client('lambda', region_name=region, config=config) for region in regions}
+    pings = [region for region in regions for _ in range(containers)]
+    if len(pings) > MAX_PINGS_IN_FLIGHT:
+        logger.warning('Only {} pings are sent at once, so fewer containers may be started'.format(MAX_PINGS_IN_FLIGHT))
+
+    logger.info('Warming {} screenshot containers in {}'.format(containers, ', '.join(regions)))
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=min(len(pings), MAX_PINGS_IN_FLIGHT)) as executor:
+        outcomes = list(executor.map(lambda region: _ping_outcome(clients[region], hold_ms), pings))
+
+    summary = {region: {'containers': set(), 'cold': 0, 'throttled': 0, 'failed': 0, 'init_ms': 0}
+               for region in regions}
+    for region, outcome in zip(pings, outcomes):
+        stats = summary[region]
+        if isinstance(outcome, dict):
+            stats['containers'].add(outcome['containerId'])
+            if outcome.get('coldStart'):
+                stats['cold'] += 1
+                stats['init_ms'] = max(stats['init_ms'], outcome.get('initMs') or 0)
+        else:
+            stats[outcome] += 1
+
+    for region in regions:
+        stats = summary[region]
+        logger.info('  {}: {} of {} containers warm, {} started cold{}{}{}'.format(
+            region, len(stats['containers']), containers, stats['cold'],
+            ' (slowest in {:.1f}s)'.format(stats['init_ms'] / 1000) if stats['cold'] else '',
+            ', {} throttled'.format(stats['throttled']) if stats['throttled'] else '',
+            ', {} failed'.format(stats['failed']) if stats['failed'] else ''))
+    logger.info('Warm-up took {:.1f}s'.format(time.time() - start))
+    return summary
+
+
+def warm(options):
+    summary = warm_regions(options.regions, options.containers, options.hold_ms)
+    if not any(stats['containers'] for stats in summary.values()):
+        logger.error('No containers could be warmed. Check that Flashbulb is deployed in these regions.')
+        exit(-1)
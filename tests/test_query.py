@@ -0,0 +1,33 @@
+import os
+import pathlib
+import subprocess
+import sys
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from modules.results_db import ResultDatabase  # noqa: E402
+
+
+def test_query_runs_without_aws(tmp_path):
+    database = ResultDatabase(tmp_path / 'results.sqlite')
+    database.add('scan/a.json', '"1"', {'startUrl': 'https://a.example', 'title': 'Dashboard',
+                                        'status': {'code': 200}, 'technologies': [{'name': 'Jenkins'}]})
+    database.add('scan/b.json', '"2"', {'startUrl': 'https://b.example', 'title': 'Welcome',
+                                        'status': {'code': 200}, 'technologies': [{'name': 'nginx'}]})
+    database.flush()
+
+    env = {name: value for name, value in os.environ.items() if not name.startswith('AWS_')}
+    env.update({
+        'HOME': str(tmp_path),
+        'AWS_CONFIG_FILE': str(tmp_path / 'missing-config'),
+        'AWS_SHARED_CREDENTIALS_FILE': str(tmp_path / 'missing-credentials'),
+        'AWS_EC2_METADATA_DISABLED': 'true',
+    })
+    completed = subprocess.run(
+        [sys.executable, 'flashbulb.py', 'query', 'bucket', 'scan', '--db', str(tmp_path / 'results.sqlite'),
+         '--tech', 'jenkins', '--output', 'urls'],
+        cwd=ROOT, env=env, capture_output=True, text=True, timeout=60)
+
+    assert completed.returncode == 0, completed.stderr
+    assert completed.stdout.split() == ['https://a.example']